@@ -3,7 +3,6 @@ from typing import Optional
 from enum import IntEnum, auto
 from numpy import random
 import numpy as np
-from matplotlib import pyplot as plt
 
 class EventoTipo(IntEnum):
     Entrada = auto()
@@ -21,6 +20,92 @@ class Cliente:
     atendido: Optional[float] = None
     saida: Optional[float] = None
 
+def mescla_eventos(chegadas, saidas):
+    # Em FIFO chegadas e saidas ja estao ordenadas, entao a posicao de cada
+    # evento na sequencia mesclada vem de uma busca na outra coluna.
+    n = len(chegadas)
+    indices = np.arange(n)
+    tempos = np.empty(2 * n)
+    variacao = np.empty(2 * n, dtype=np.int64)
+    pos_chegadas = indices + np.searchsorted(saidas, chegadas, side='left')
+    pos_saidas = indices + np.searchsorted(chegadas, saidas, side='right')
+    tempos[pos_chegadas] = chegadas
+    tempos[pos_saidas] = saidas
+    variacao[pos_chegadas] = 1
+    variacao[pos_saidas] = -1
+    return tempos, variacao
+
+class Clientes:
+    # Armazena os clientes em colunas (chegada, atendido, saida) de float64,
+    # crescendo a capacidade em dobro como uma lista.
+    def __init__(self, capacidade=16):
+        self._chegada = np.empty(capacidade)
+        self._atendido = np.empty(capacidade)
+        self._saida = np.empty(capacidade)
+        self._n = 0
+
+    @property
+    def chegada(self):
+        return self._chegada[:self._n]
+
+    @property
+    def atendido(self):
+        return self._atendido[:self._n]
+
+    @property
+    def saida(self):
+        return self._saida[:self._n]
+
+    def __len__(self):
+        return self._n
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self._n
+        if not 0 <= i < self._n:
+            raise IndexError(i)
+        return Cliente(chegada=float(self._chegada[i]),
+                       atendido=float(self._atendido[i]),
+                       saida=float(self._saida[i]))
+
+    def __iter__(self):
+        return map(Cliente, self.chegada.tolist(),
+                   self.atendido.tolist(), self.saida.tolist())
+
+    def reserva(self, n):
+        if n <= len(self._chegada):
+            return
+        capacidade = max(n, 2 * len(self._chegada))
+        for nome in ('_chegada', '_atendido', '_saida'):
+            novo = np.empty(capacidade)
+            novo[:self._n] = getattr(self, nome)[:self._n]
+            setattr(self, nome, novo)
+
+    def append(self, cliente: Cliente):
+        self.reserva(self._n + 1)
+        self._chegada[self._n] = cliente.chegada
+        self._atendido[self._n] = cliente.atendido
+        self._saida[self._n] = cliente.saida
+        self._n += 1
+
+    def estende(self, chegadas, atendidos, saidas):
+        fim = self._n + len(chegadas)
+        self.reserva(fim)
+        self._chegada[self._n:fim] = chegadas
+        self._atendido[self._n:fim] = atendidos
+        self._saida[self._n:fim] = saidas
+        self._n = fim
+
+def lindley(chegadas, servicos, ultima_saida=0.0):
+    # saida_i = max(chegada_i, saida_{i-1}) + servico_i, resolvido em bloco:
+    # saida_i = C_i + max(ultima_saida, max_{j<=i}(chegada_j - C_{j-1}))
+    acumulado = np.cumsum(servicos)
+    folga = np.maximum.accumulate(chegadas - (acumulado - servicos))
+    saidas = acumulado + np.maximum(folga, ultima_saida)
+    saidas_anteriores = np.concatenate(([ultima_saida], saidas[:-1]))
+    atendidos = np.maximum(chegadas, saidas_anteriores)
+    return atendidos, saidas
+
 # @dataclass
 # class Estatisticas:
     
@@ -33,7 +118,7 @@ class Servidor:
     mu: float
     tempo_maximo: float
 
-    processados: list[Cliente] = field(default_factory=list)
+    processados: Clientes = field(default_factory=Clientes)
     
     def proximo_cliente(self, ultimo_cliente: Cliente) -> Cliente:
         chegada = ultimo_cliente.chegada + self.chegada_aleatoria()
@@ -41,12 +126,32 @@ class Servidor:
         return Cliente(chegada=chegada, atendido=atendido,
                        saida=atendido+self.tempo_de_processamento())
         
-    def run(self):
-        atual_cliente = Cliente(chegada=0, atendido=0,
-                                   saida=self.tempo_de_processamento())
-        while atual_cliente.saida < self.tempo_maximo:
-            self.processados.append(atual_cliente)
-            atual_cliente = self.proximo_cliente(atual_cliente)
+    def run(self, bloco=None):
+        for chegadas, atendidos, saidas in self.blocos(bloco):
+            self.processados.estende(chegadas, atendidos, saidas)
+
+    def blocos(self, bloco=None):
+        if bloco is None:
+            bloco = min(int(self.lamda * self.tempo_maximo * 1.1) + 16, 1 << 16)
+        ultima_chegada = 0.0
+        ultima_saida = 0.0
+        primeiro = True
+        while True:
+            intervalos = self.chegadas_aleatorias(bloco)
+            if primeiro:
+                intervalos[0] = 0.0
+                primeiro = False
+            chegadas = ultima_chegada + np.cumsum(intervalos)
+            atendidos, saidas = lindley(chegadas, self.tempos_de_processamento(bloco),
+                                        ultima_saida)
+            fim = np.searchsorted(saidas, self.tempo_maximo, side='left')
+            if fim < bloco:
+                if fim > 0:
+                    yield chegadas[:fim], atendidos[:fim], saidas[:fim]
+                return
+            yield chegadas, atendidos, saidas
+            ultima_chegada = chegadas[-1]
+            ultima_saida = saidas[-1]
 
     def run_until_empty(self):
         atual_cliente = Cliente(chegada=0, atendido=0,
@@ -87,13 +192,21 @@ class Servidor:
     def tempo_de_processamento(self):
         return random.exponential(1/self.mu)
 
+    def chegadas_aleatorias(self, n):
+        return random.exponential(1/self.lamda, size=n)
+
+    def tempos_de_processamento(self, n):
+        return random.exponential(1/self.mu, size=n)
+
     def eventos(self):            
         eventos = []
         
-        for cliente in self.processados:
-            eventos.append(Evento(EventoTipo.Entrada, cliente.chegada))
-            eventos.append(Evento(EventoTipo.Saida, cliente.saida))
-            eventos.append(Evento(EventoTipo.Atendido, cliente.atendido))
+        for chegada, atendido, saida in zip(self.processados.chegada.tolist(),
+                                            self.processados.atendido.tolist(),
+                                            self.processados.saida.tolist()):
+            eventos.append(Evento(EventoTipo.Entrada, chegada))
+            eventos.append(Evento(EventoTipo.Saida, saida))
+            eventos.append(Evento(EventoTipo.Atendido, atendido))
         return sorted(eventos, key=lambda evento: evento.tempo)
     
     def info(self):
@@ -111,10 +224,20 @@ class Servidor:
                     na_fila -= 1
                 case EventoTipo.Entrada:
                     na_fila += 1
-        waiting_time = sum(cliente.atendido - cliente.chegada for cliente in self.processados)
+        waiting_time = np.sum(self.processados.atendido - self.processados.chegada)
         mean_waiting_time = waiting_time / len(self.processados)
         mean_pessoas_area = pessoas_area / self.tempo_maximo
         return mean_pessoas_area, mean_waiting_time, cdf_pessoas
+
+    def info_linear(self):
+        tempos, variacao = mescla_eventos(self.processados.chegada, self.processados.saida)
+        na_fila = np.cumsum(variacao) - variacao
+        pessoas_area = np.cumsum(na_fila * np.diff(tempos, prepend=0.0))
+        cdf_pessoas = np.column_stack((pessoas_area, tempos))
+        waiting_time = np.sum(self.processados.atendido - self.processados.chegada)
+        mean_waiting_time = waiting_time / len(self.processados)
+        mean_pessoas_area = pessoas_area[-1] / self.tempo_maximo
+        return mean_pessoas_area, mean_waiting_time, cdf_pessoas
         
     # def plot(self):
     #     [x, y] = list(zip(*points))
@@ -134,6 +257,7 @@ def gera_cdfs(lamda, mu, tempo_maximo=100):
     serv.run()
     _, _, cdf = serv.info()
     [tempo, pessoas] = list(zip(*cdf))
+    from matplotlib import pyplot as plt
     fig = plt.figure(figsize=(10, 5))
     
     fig.suptitle(f"M/M/1 ($\\lambda$ = {lamda}, $\\mu$ = {mu})")
@@ -142,11 +266,7 @@ def gera_cdfs(lamda, mu, tempo_maximo=100):
     clientes.plot(tempo, pessoas)
 
     x = range(len(serv.processados))
-    y = []
-    soma = 0
-    for cliente in serv.processados:
-        soma += cliente.saida - cliente.chegada
-        y.append(soma)
+    y = np.cumsum(serv.processados.saida - serv.processados.chegada)
     espera.set_title("Cdf do tempo de espera")
     espera.plot(x, y)
 
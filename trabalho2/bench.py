@@ -0,0 +1,168 @@
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from filas import (Servidor, compara_casos, executa_replicacoes, replica_epidemia,
+                   replica_ramificacao, replica_servidor)
+
+TAMANHOS = [1_000, 10_000, 100_000, 1_000_000, 10_000_000]
+UTILIZACOES = [0.5, 0.8, 0.95, 1.05, 1.1]
+
+
+def mede(funcao, repeticoes):
+    # menor tempo entre as repeticoes; o pico de memoria vem de uma rodada a
+    # parte com tracemalloc, que deixa a execucao mais lenta
+    tempos = []
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        funcao()
+        tempos.append(time.perf_counter() - inicio)
+    tracemalloc.start()
+    funcao()
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(tempos), pico
+
+
+def servidor_rodado(rho, n, seed):
+    serv = Servidor(lamda=rho, mu=1, tempo_maximo=n / rho, rng=np.random.default_rng(seed))
+    serv.run()
+    return serv
+
+
+def semente_sobrevivente(rho, seed, tentativas=1000):
+    # a arvore so cobre o primeiro periodo ocupado; com rho > 1 procura uma
+    # semente em que ele nao se extingue, testando num horizonte curto (as
+    # amostras de um horizonte sao prefixo das de um horizonte maior)
+    if rho <= 1:
+        return seed
+    for semente in range(seed, seed + tentativas):
+        serv = servidor_rodado(rho, 10_000, semente)
+        serv.gera_arvore()
+        if len(serv.arvore) == len(serv.processados):
+            return semente
+    return seed
+
+
+def caminhos(rho, n, seed, limite_objetos):
+    # cada entrada: nome, funcao a medir e quantos itens ela processa
+    serv = servidor_rodado(rho, n, seed)
+    clientes = len(serv.processados)
+    yield 'run', lambda: servidor_rodado(rho, n, seed), clientes
+    yield 'info_clientes_linear', serv.info_clientes_linear, 2 * clientes
+    arvore = servidor_rodado(rho, n, semente_sobrevivente(rho, seed))
+    arvore.gera_arvore()
+    yield 'gera_arvore', arvore.gera_arvore, len(arvore.arvore)
+    yield 'info_arvore', arvore.info_arvore, len(arvore.arvore)
+    if clientes <= limite_objetos:
+        yield 'eventos', serv.eventos, 3 * clientes
+        yield 'info_clientes', serv.info_clientes, 3 * clientes
+
+
+def replicacoes(rho, seed, workers):
+    parametros = dict(lamda=rho, mu=1, tempo_maximo=1000)
+    yield ('simula_servidores', 100,
+           lambda: executa_replicacoes(replica_servidor, 100, workers=workers, seed=seed,
+                                       **parametros))
+    yield ('simula_epidemias', 1000,
+           lambda: executa_replicacoes(replica_epidemia, 1000, workers=workers, seed=seed,
+                                       deterministic=False, **parametros))
+    yield ('simula_epidemias_ramificacao', 1000,
+           lambda: executa_replicacoes(replica_ramificacao, 1000, workers=workers, seed=seed,
+                                       **parametros))
+
+
+def roda(tamanhos, utilizacoes, repeticoes, limite_objetos, workers, seed):
+    resultados = []
+    for rho in utilizacoes:
+        for n in tamanhos:
+            for nome, funcao, itens in caminhos(rho, n, seed, limite_objetos):
+                tempo, pico = mede(funcao, repeticoes)
+                resultados.append(dict(caminho=nome, rho=rho, n=n, itens=itens, tempo=tempo,
+                                       itens_por_segundo=itens / tempo if tempo else None,
+                                       pico_memoria=pico))
+                print(f"{nome:32s} rho={rho:<5} n={n:<9} {tempo:9.4f}s "
+                      f"{itens / tempo:12.3e} itens/s  {pico / 2**20:9.1f} MiB", flush=True)
+        for nome, n, funcao in replicacoes(rho, seed, workers):
+            tempo, pico = mede(funcao, 1)
+            resultados.append(dict(caminho=nome, rho=rho, n=n, itens=n, tempo=tempo,
+                                   itens_por_segundo=n / tempo, pico_memoria=pico))
+            print(f"{nome:32s} rho={rho:<5} n={n:<9} {tempo:9.4f}s "
+                  f"{n / tempo:12.3e} replicações/s", flush=True)
+    return resultados
+
+
+def confere_workers(seed):
+    # os resultados nao podem depender de quantos workers rodam, inclusive
+    # com numeros aleatorios comuns e pares antiteticos entre os casos
+    casos = [dict(lamda=1, mu=2, tempo_maximo=200), dict(lamda=1.1, mu=2, tempo_maximo=200)]
+    sequencial, _ = compara_casos(replica_servidor, casos, n=200, seed=seed,
+                                  antitetico=True, workers=1)
+    paralelo, _ = compara_casos(replica_servidor, casos, n=200, seed=seed,
+                                antitetico=True, workers=2)
+    return all(np.array_equal(a, b) for a, b in zip(sequencial, paralelo))
+
+
+def commit_atual():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compara(resultados, base, limiar):
+    chave = lambda r: (r['caminho'], r['rho'], r['n'])
+    anteriores = {chave(r): r for r in base['resultados']}
+    regressoes = []
+    for resultado in resultados:
+        anterior = anteriores.get(chave(resultado))
+        if anterior is None:
+            continue
+        razao = resultado['tempo'] / anterior['tempo']
+        if razao > 1 + limiar:
+            regressoes.append((chave(resultado), razao))
+            print(f"REGRESSÃO {resultado['caminho']} rho={resultado['rho']} n={resultado['n']}: "
+                  f"{anterior['tempo']:.4f}s -> {resultado['tempo']:.4f}s ({razao:.2f}x)")
+    return regressoes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks dos caminhos quentes de filas.py")
+    parser.add_argument('--tamanhos', type=int, nargs='+', default=TAMANHOS)
+    parser.add_argument('--utilizacoes', type=float, nargs='+', default=UTILIZACOES)
+    parser.add_argument('--repeticoes', type=int, default=3)
+    parser.add_argument('--limite-objetos', type=int, default=1_000_000,
+                        help="maior número de clientes para os caminhos com objetos Evento")
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--saida', default='bench.json')
+    parser.add_argument('--base', help="JSON de uma rodada anterior para comparar")
+    parser.add_argument('--limiar', type=float, default=0.2,
+                        help="aumento relativo de tempo considerado regressão")
+    parser.add_argument('--confere', action='store_true',
+                        help="só confere que workers=1 e workers=2 dão os mesmos resultados")
+    args = parser.parse_args()
+
+    if args.confere:
+        if not confere_workers(args.seed):
+            print("compara_casos muda com o número de workers")
+            sys.exit(1)
+        sys.exit(0)
+
+    resultados = roda(args.tamanhos, args.utilizacoes, args.repeticoes,
+                      args.limite_objetos, args.workers, args.seed)
+    with open(args.saida, 'w') as arquivo:
+        json.dump(dict(commit=commit_atual(), python=platform.python_version(),
+                       numpy=np.__version__, maquina=platform.platform(),
+                       resultados=resultados), arquivo, indent=2)
+    if args.base:
+        with open(args.base) as arquivo:
+            if compara(resultados, json.load(arquivo), args.limiar):
+                sys.exit(1)
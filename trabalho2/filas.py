@@ -1,21 +1,38 @@
 from dataclasses import dataclass, field
-from typing import Optional
+from typing import Optional, ClassVar
+from functools import partial, wraps
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ProcessPoolExecutor
+from statistics import NormalDist
+from collections import deque
+import hashlib
+import heapq
+import itertools
+import csv
+import json
+import math
+import os
+import pickle
+import sys
+import time
 from enum import IntEnum, auto
-from numpy import random
 import numpy as np
-from matplotlib import pyplot as plt
-from typing_extensions import Self
 from pprint import pprint
 
+# muda quando uma alteracao nos motores invalida resultados ja guardados
+VERSAO_MOTOR = 1
+
 class EventoTipo(IntEnum):
     Entrada = auto()
     Saida = auto()
     Atendido = auto()
 
-@dataclass
+@dataclass(slots=True)
 class Evento:
     tipo : EventoTipo
     tempo: float
+    estacao: int = 0
+    cliente: int = -1
         
 @dataclass
 class Cliente:
@@ -23,17 +40,588 @@ class Cliente:
     atendido: Optional[float] = None
     saida: Optional[float] = None
 
+def mescla_eventos(chegadas, saidas):
+    # Em FIFO chegadas e saidas ja estao ordenadas, entao a posicao de cada
+    # evento na sequencia mesclada vem de uma busca na outra coluna.
+    n = len(chegadas) + len(saidas)
+    tempos = np.empty(n)
+    variacao = np.empty(n, dtype=np.int64)
+    pos_chegadas = np.arange(len(chegadas)) + np.searchsorted(saidas, chegadas, side='left')
+    pos_saidas = np.arange(len(saidas)) + np.searchsorted(chegadas, saidas, side='right')
+    tempos[pos_chegadas] = chegadas
+    tempos[pos_saidas] = saidas
+    variacao[pos_chegadas] = 1
+    variacao[pos_saidas] = -1
+    return tempos, variacao
+
+def area_acumulada(chegadas, saidas, tempos):
+    # integral de N(t) de 0 ate cada tempo: soma de (T - chegada) de quem ja
+    # chegou menos a soma de (T - saida) de quem ja saiu
+    soma_chegadas = np.concatenate(([0.0], np.cumsum(chegadas)))
+    soma_saidas = np.concatenate(([0.0], np.cumsum(saidas)))
+    n_chegadas = np.searchsorted(chegadas, tempos, side='right')
+    n_saidas = np.searchsorted(saidas, tempos, side='right')
+    return ((n_chegadas - n_saidas) * tempos
+            - soma_chegadas[n_chegadas] + soma_saidas[n_saidas])
+
+def no_sistema(chegadas, saidas, tempos):
+    # N(t) em cada tempo da grade: quem ja chegou menos quem ja saiu
+    return (np.searchsorted(chegadas, tempos, side='right')
+            - np.searchsorted(saidas, tempos, side='right'))
+
+def ocupacao_media(areas, bordas):
+    # media temporal de N(t) em cada janela [bordas[k], bordas[k+1])
+    return np.diff(areas) / np.diff(bordas)
+
+class Clientes:
+    # Armazena os clientes em colunas (chegada, atendido, saida) de float64,
+    # crescendo a capacidade em dobro como uma lista.
+    def __init__(self, capacidade=16):
+        self._chegada = np.empty(capacidade)
+        self._atendido = np.empty(capacidade)
+        self._saida = np.empty(capacidade)
+        self._n = 0
+
+    @property
+    def chegada(self):
+        return self._chegada[:self._n]
+
+    @property
+    def atendido(self):
+        return self._atendido[:self._n]
+
+    @property
+    def saida(self):
+        return self._saida[:self._n]
+
+    def __len__(self):
+        return self._n
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self._n
+        if not 0 <= i < self._n:
+            raise IndexError(i)
+        return Cliente(chegada=float(self._chegada[i]),
+                       atendido=float(self._atendido[i]),
+                       saida=float(self._saida[i]))
+
+    def __iter__(self):
+        return map(Cliente, self.chegada.tolist(),
+                   self.atendido.tolist(), self.saida.tolist())
+
+    def reserva(self, n):
+        if n <= len(self._chegada):
+            return
+        capacidade = max(n, 2 * len(self._chegada))
+        for nome in ('_chegada', '_atendido', '_saida'):
+            novo = np.empty(capacidade)
+            novo[:self._n] = getattr(self, nome)[:self._n]
+            setattr(self, nome, novo)
+
+    def append(self, cliente: Cliente):
+        self.reserva(self._n + 1)
+        self._chegada[self._n] = cliente.chegada
+        self._atendido[self._n] = cliente.atendido
+        self._saida[self._n] = cliente.saida
+        self._n += 1
+
+    def estende(self, chegadas, atendidos, saidas):
+        fim = self._n + len(chegadas)
+        self.reserva(fim)
+        self._chegada[self._n:fim] = chegadas
+        self._atendido[self._n:fim] = atendidos
+        self._saida[self._n:fim] = saidas
+        self._n = fim
+
+    def no_sistema(self, tempos):
+        return no_sistema(self.chegada, self.saida, np.asarray(tempos, dtype=float))
+
+    def area_acumulada(self, tempos):
+        return area_acumulada(self.chegada, self.saida, np.asarray(tempos, dtype=float))
+
+    def ocupacao(self, bordas):
+        bordas = np.asarray(bordas, dtype=float)
+        return ocupacao_media(self.area_acumulada(bordas), bordas)
+
+class Rastro:
+    # Clientes gravados em disco, em pedacos .npy de tamanho fixo mapeados em
+    # memoria (uma linha por coluna: chegada, atendido, saida). rastro.json
+    # guarda quantos clientes valem; o que passar disso e lixo de uma
+    # execucao interrompida e e sobrescrito.
+    def __init__(self, diretorio, tamanho_pedaco=1 << 22):
+        self.diretorio = diretorio
+        os.makedirs(diretorio, exist_ok=True)
+        indice = os.path.join(diretorio, 'rastro.json')
+        if os.path.exists(indice):
+            with open(indice) as arquivo:
+                dados = json.load(arquivo)
+            tamanho_pedaco = dados['tamanho_pedaco']
+            self._n = dados['clientes']
+        else:
+            self._n = 0
+        self.tamanho_pedaco = tamanho_pedaco
+        self._aberto = None
+
+    def __len__(self):
+        return self._n
+
+    def caminho(self, numero):
+        return os.path.join(self.diretorio, f'pedaco_{numero:06d}.npy')
+
+    def pedaco_para_escrita(self, numero):
+        if self._aberto is not None and self._aberto[0] == numero:
+            return self._aberto[1]
+        self.fecha()
+        caminho = self.caminho(numero)
+        if os.path.exists(caminho):
+            mapa = np.load(caminho, mmap_mode='r+')
+        else:
+            mapa = np.lib.format.open_memmap(caminho, mode='w+', dtype=np.float64,
+                                             shape=(3, self.tamanho_pedaco))
+        self._aberto = (numero, mapa)
+        return mapa
+
+    def estende(self, chegadas, atendidos, saidas):
+        inicio = 0
+        while inicio < len(chegadas):
+            numero, posicao = divmod(self._n, self.tamanho_pedaco)
+            fim = min(len(chegadas), inicio + self.tamanho_pedaco - posicao)
+            mapa = self.pedaco_para_escrita(numero)
+            destino = slice(posicao, posicao + fim - inicio)
+            mapa[0, destino] = chegadas[inicio:fim]
+            mapa[1, destino] = atendidos[inicio:fim]
+            mapa[2, destino] = saidas[inicio:fim]
+            self._n += fim - inicio
+            inicio = fim
+
+    def trunca(self, n):
+        self._n = n
+        self.descarrega()
+
+    def fecha(self):
+        if self._aberto is not None:
+            self._aberto[1].flush()
+            self._aberto = None
+
+    def descarrega(self):
+        self.fecha()
+        temporario = os.path.join(self.diretorio, 'rastro.json.tmp')
+        with open(temporario, 'w') as arquivo:
+            json.dump(dict(clientes=self._n, tamanho_pedaco=self.tamanho_pedaco), arquivo)
+        os.replace(temporario, os.path.join(self.diretorio, 'rastro.json'))
+
+    def pedacos(self):
+        self.fecha()
+        for numero in range(-(-self._n // self.tamanho_pedaco)):
+            fim = min(self.tamanho_pedaco, self._n - numero * self.tamanho_pedaco)
+            mapa = np.load(self.caminho(numero), mmap_mode='r')
+            yield mapa[0, :fim], mapa[1, :fim], mapa[2, :fim]
+
+    # N(t) e a area ate t somam a contribuicao de cada cliente, entao saem
+    # somando pedaco a pedaco sem mesclar os eventos
+    def no_sistema(self, tempos):
+        tempos = np.asarray(tempos, dtype=float)
+        total = np.zeros(tempos.shape, dtype=np.int64)
+        for chegadas, _, saidas in self.pedacos():
+            total += no_sistema(chegadas, saidas, tempos)
+        return total
+
+    def area_acumulada(self, tempos):
+        tempos = np.asarray(tempos, dtype=float)
+        total = np.zeros(tempos.shape)
+        for chegadas, _, saidas in self.pedacos():
+            total += area_acumulada(chegadas, saidas, tempos)
+        return total
+
+    def ocupacao(self, bordas):
+        bordas = np.asarray(bordas, dtype=float)
+        return ocupacao_media(self.area_acumulada(bordas), bordas)
+
+    def eventos(self):
+        # mescla_eventos pedaco a pedaco: as saidas a partir da ultima chegada
+        # do pedaco ainda podem vir depois de chegadas do proximo, entao ficam
+        # pendentes ate la
+        pendentes = np.empty(0)
+        for chegadas, _, saidas in self.pedacos():
+            saidas = np.concatenate((pendentes, saidas))
+            corte = np.searchsorted(saidas, chegadas[-1], side='left')
+            pendentes = saidas[corte:]
+            yield mescla_eventos(chegadas, saidas[:corte])
+        if len(pendentes):
+            yield mescla_eventos(np.empty(0), pendentes)
+
+    def cdf_pessoas(self):
+        na_fila = 0
+        pessoas_area = 0.0
+        ultimo_tempo = 0.0
+        for tempos, variacao in self.eventos():
+            antes = na_fila + np.cumsum(variacao) - variacao
+            area = pessoas_area + np.cumsum(antes * np.diff(tempos, prepend=ultimo_tempo))
+            yield np.column_stack((area, tempos))
+            na_fila = antes[-1] + variacao[-1]
+            pessoas_area = area[-1]
+            ultimo_tempo = tempos[-1]
+
+    def permanencias_acumuladas(self):
+        inicio, total = 0, 0.0
+        for chegadas, _, saidas in self.pedacos():
+            acumuladas = total + np.cumsum(saidas - chegadas)
+            yield np.arange(inicio, inicio + len(acumuladas)), acumuladas
+            inicio, total = inicio + len(acumuladas), acumuladas[-1]
+
+    def info_clientes(self, tempo_maximo):
+        # a cdf vem como um gerador de pedacos para nao carregar tudo
+        espera = permanencia = 0.0
+        for chegadas, atendidos, saidas in self.pedacos():
+            espera += float(np.sum(atendidos - chegadas))
+            permanencia += float(np.sum(saidas - chegadas))
+        return permanencia / tempo_maximo, espera / self._n, self.cdf_pessoas()
+
+def lindley(chegadas, servicos, ultima_saida=0.0):
+    # saida_i = max(chegada_i, saida_{i-1}) + servico_i, resolvido em bloco:
+    # saida_i = C_i + max(ultima_saida, max_{j<=i}(chegada_j - C_{j-1}))
+    acumulado = np.cumsum(servicos)
+    folga = np.maximum.accumulate(chegadas - (acumulado - servicos))
+    saidas = acumulado + np.maximum(folga, ultima_saida)
+    saidas_anteriores = np.concatenate(([ultima_saida], saidas[:-1]))
+    atendidos = np.maximum(chegadas, saidas_anteriores)
+    return atendidos, saidas
+
 # @dataclass
 # class Estatisticas:
 
-@dataclass   
-class Infectado:
-    geracao: int
-    filhos: list[Self] = field(default_factory=list)
+# Distribuicoes sorteadas por transformada inversa: cada variavel consome
+# n_uniformes uniformes em [0, 1).
+@dataclass
+class Exponencial:
+    taxa: float
+    n_uniformes: ClassVar[int] = 1
 
-    def adicionar_filho(self, filho : Self):
-        self.filhos.append(filho)
-        
+    def inversa(self, u):
+        return -np.log1p(-u[:, 0]) / self.taxa
+
+@dataclass
+class Deterministica:
+    valor: float
+    n_uniformes: ClassVar[int] = 0
+
+    def inversa(self, u):
+        return np.full(len(u), self.valor)
+
+@dataclass
+class Erlang:
+    fases: int
+    taxa: float
+
+    @property
+    def n_uniformes(self):
+        return self.fases
+
+    def inversa(self, u):
+        return -np.log1p(-u).sum(axis=1) / self.taxa
+
+@dataclass
+class Hiperexponencial:
+    probabilidades: tuple[float, ...]
+    taxas: tuple[float, ...]
+    n_uniformes: ClassVar[int] = 2
+
+    def inversa(self, u):
+        ramo = np.searchsorted(np.cumsum(self.probabilidades)[:-1], u[:, 0], side='right')
+        return -np.log1p(-u[:, 1]) / np.asarray(self.taxas)[ramo]
+
+@dataclass
+class Empirica:
+    valores: np.ndarray
+    n_uniformes: ClassVar[int] = 1
+
+    def __post_init__(self):
+        self.valores = np.sort(np.asarray(self.valores, dtype=float))
+
+    def inversa(self, u):
+        return self.valores[(u[:, 0] * len(self.valores)).astype(np.int64)]
+
+@dataclass
+class Uniforme:
+    inicio: float
+    fim: float
+    n_uniformes: ClassVar[int] = 1
+
+    def inversa(self, u):
+        return self.inicio + (self.fim - self.inicio) * u[:, 0]
+
+def geradores_filhos(rng, n):
+    # Os mesmos filhos de rng.spawn(n), mas sem avancar o contador da
+    # SeedSequence: ela e compartilhada entre as chamadas de executa_sementes
+    # (numeros aleatorios comuns) e nao pode mudar entre um caso e outro.
+    semente = rng.bit_generator.seed_seq
+    if not isinstance(semente, np.random.SeedSequence):
+        return rng.spawn(n)
+    return [np.random.Generator(type(rng.bit_generator)(
+                np.random.SeedSequence(semente.entropy, spawn_key=semente.spawn_key + (i,),
+                                       pool_size=semente.pool_size)))
+            for i in range(n)]
+
+class Amostrador:
+    # Sorteia a distribuicao em blocos e entrega um valor por vez do buffer;
+    # pedidos vetoriais consomem primeiro o que sobrou no buffer, entao a
+    # sequencia de valores nao depende de como eles foram pedidos. Com
+    # antitetico=True cada uniforme u vira 1 - u. O buffer comeca com
+    # inicial valores e dobra a cada recarga ate bloco, para que periodos
+    # ocupados curtos nao paguem por um bloco inteiro.
+    def __init__(self, distribuicao, rng, bloco=4096, antitetico=False, inicial=8):
+        self.distribuicao = distribuicao
+        self.rng = rng
+        self.bloco = bloco
+        self.proximo_bloco = min(inicial, bloco)
+        self.antitetico = antitetico
+        self.buffer = np.empty(0)
+        self.posicao = 0
+        self.sorteios = 0
+
+    def __call__(self):
+        if self.posicao == len(self.buffer):
+            self.buffer = self.sorteia(self.proximo_bloco)
+            self.proximo_bloco = min(2 * self.proximo_bloco, self.bloco)
+            self.posicao = 0
+        valor = self.buffer[self.posicao]
+        self.posicao += 1
+        return valor
+
+    def amostras(self, n):
+        sobra = self.buffer[self.posicao:self.posicao + n]
+        self.posicao += len(sobra)
+        if len(sobra) == n:
+            return sobra.copy()
+        return np.concatenate((sobra, self.sorteia(n - len(sobra))))
+
+    def espia(self, n):
+        # os proximos n valores sem consumi-los: eles ficam no buffer e saem
+        # depois, na mesma ordem, por __call__ ou amostras
+        falta = n - (len(self.buffer) - self.posicao)
+        if falta > 0:
+            self.buffer = np.concatenate((self.buffer[self.posicao:], self.sorteia(falta)))
+            self.posicao = 0
+        return self.buffer[self.posicao:self.posicao + n].copy()
+
+    def sorteia(self, n):
+        self.sorteios += n
+        u = self.rng.random((n, self.distribuicao.n_uniformes))
+        if self.antitetico:
+            # mantem o intervalo [0, 1) para a inversa nao dar infinito
+            u = np.nextafter(1.0, 0.0) - u
+        return self.distribuicao.inversa(u)
+
+@dataclass
+class Welford:
+    n: int = 0
+    media: float = 0.0
+    m2: float = 0.0
+
+    def adiciona(self, valores):
+        # junta o bloco inteiro de uma vez (Chan et al.)
+        n_bloco = len(valores)
+        if n_bloco == 0:
+            return
+        media_bloco = float(np.mean(valores))
+        m2_bloco = float(np.sum((valores - media_bloco) ** 2))
+        n = self.n + n_bloco
+        delta = media_bloco - self.media
+        self.media += delta * n_bloco / n
+        self.m2 += m2_bloco + delta ** 2 * self.n * n_bloco / n
+        self.n = n
+
+    def variancia(self):
+        return self.m2 / (self.n - 1) if self.n > 1 else 0.0
+
+class TDigest:
+    # t-digest de fusao: os centroides e o bloco novo sao ordenados juntos e
+    # agrupados pela funcao de escala k1, que deixa grupos pequenos nas caudas.
+    def __init__(self, compressao=100):
+        self.compressao = compressao
+        self.medias = np.empty(0)
+        self.pesos = np.empty(0)
+        self.minimo = np.inf
+        self.maximo = -np.inf
+
+    def adiciona(self, valores):
+        if len(valores) == 0:
+            return
+        self.minimo = min(self.minimo, float(np.min(valores)))
+        self.maximo = max(self.maximo, float(np.max(valores)))
+        medias = np.concatenate((self.medias, valores))
+        pesos = np.concatenate((self.pesos, np.ones(len(valores))))
+        ordem = np.argsort(medias, kind='stable')
+        medias = medias[ordem]
+        pesos = pesos[ordem]
+        q = (np.cumsum(pesos) - pesos / 2) / np.sum(pesos)
+        k = np.floor(self.compressao * (np.arcsin(2 * q - 1) / np.pi + 0.5))
+        inicios = np.flatnonzero(np.diff(k, prepend=-1))
+        self.pesos = np.add.reduceat(pesos, inicios)
+        self.medias = np.add.reduceat(medias * pesos, inicios) / self.pesos
+
+    def quantil(self, q):
+        total = np.sum(self.pesos)
+        posicoes = np.concatenate(([0], np.cumsum(self.pesos) - self.pesos / 2, [total]))
+        valores = np.concatenate(([self.minimo], self.medias, [self.maximo]))
+        return np.interp(np.asarray(q) * total, posicoes, valores)
+
+@dataclass
+class Acumuladores:
+    espera: Welford = field(default_factory=Welford)
+    permanencia: TDigest = field(default_factory=TDigest)
+    pessoas_area: float = 0.0
+    max_no_sistema: int = 0
+    # saidas de quem ainda estava no sistema na ultima chegada vista
+    em_sistema: np.ndarray = field(default_factory=lambda: np.empty(0))
+
+    def adiciona(self, chegadas, atendidos, saidas):
+        self.espera.adiciona(atendidos - chegadas)
+        permanencias = saidas - chegadas
+        self.permanencia.adiciona(permanencias)
+        self.pessoas_area += float(np.sum(permanencias))
+        # numero no sistema logo apos cada chegada, contando quem veio antes
+        combinadas = np.concatenate((self.em_sistema, saidas))
+        posicoes = len(self.em_sistema) + np.arange(1, len(chegadas) + 1)
+        no_sistema = posicoes - np.searchsorted(combinadas, chegadas, side='right')
+        self.max_no_sistema = max(self.max_no_sistema, int(no_sistema.max()))
+        self.em_sistema = combinadas[combinadas > chegadas[-1]]
+
+class Perfil:
+    # Tempo de parede e de CPU por fase e contadores. Um Servidor so mede
+    # quando tem um Perfil, e os perfis das replicacoes se somam com junta.
+    def __init__(self):
+        self.fases = {}
+        self.contadores = {}
+
+    @contextmanager
+    def fase(self, nome):
+        parede, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield self
+        finally:
+            chamadas, total_parede, total_cpu = self.fases.get(nome, (0, 0.0, 0.0))
+            self.fases[nome] = (chamadas + 1, total_parede + time.perf_counter() - parede,
+                                total_cpu + time.process_time() - cpu)
+
+    def conta(self, nome, n=1):
+        self.contadores[nome] = self.contadores.get(nome, 0) + int(n)
+
+    def junta(self, outro):
+        for nome, valores in outro.fases.items():
+            anteriores = self.fases.get(nome, (0, 0.0, 0.0))
+            self.fases[nome] = tuple(a + b for a, b in zip(anteriores, valores))
+        for nome, n in outro.contadores.items():
+            self.conta(nome, n)
+        return self
+
+    def relatorio(self):
+        linhas = [f"{'fase':<12} {'chamadas':>10} {'parede (s)':>12} {'cpu (s)':>12}"]
+        for nome, (chamadas, parede, cpu) in sorted(self.fases.items(),
+                                                    key=lambda item: -item[1][1]):
+            linhas.append(f"{nome:<12} {chamadas:>10} {parede:>12.4f} {cpu:>12.4f}")
+        for nome, n in self.contadores.items():
+            linhas.append(f"{nome:<12} {n:>10}")
+        return "\n".join(linhas)
+
+    def resumo(self):
+        # o mesmo conteudo do relatorio como um dicionario plano
+        resumo = {}
+        for nome, (chamadas, parede, cpu) in self.fases.items():
+            resumo.update({f'perfil_{nome}_chamadas': chamadas,
+                           f'perfil_{nome}_parede': parede, f'perfil_{nome}_cpu': cpu})
+        resumo.update({f'perfil_{nome}': n for nome, n in self.contadores.items()})
+        return resumo
+
+def medido(nome):
+    # sem perfil o custo e um teste de None por chamada do metodo
+    def decorador(metodo):
+        @wraps(metodo)
+        def envolvido(self, *args, **kwargs):
+            if self.perfil is None:
+                return metodo(self, *args, **kwargs)
+            sorteios = self.sorteios()
+            with self.perfil.fase(nome):
+                resultado = metodo(self, *args, **kwargs)
+            self.perfil.conta('sorteios', self.sorteios() - sorteios)
+            return resultado
+        return envolvido
+    return decorador
+
+@dataclass
+class Arvore:
+    # Arvore de infeccao guardada em ordem de atendimento: pai[i] e o indice
+    # de quem estava sendo atendido na chegada de i, e cada geracao ocupa o
+    # intervalo limites[g]:limites[g+1].
+    pai: np.ndarray
+    geracao: np.ndarray
+    limites: np.ndarray
+
+    @classmethod
+    def da_fila(cls, chegadas, saidas):
+        pai = np.searchsorted(saidas, chegadas, side='right')
+        pai[0] = -1
+        return cls.dos_pais(pai)
+
+    @classmethod
+    def dos_pais(cls, pai):
+        limites = [0, 1]
+        while limites[-1] < len(pai):
+            proximo = np.searchsorted(pai, limites[-1], side='left')
+            if proximo == limites[-1]:
+                break
+            limites.append(int(proximo))
+        limites = np.array(limites)
+        geracao = np.repeat(np.arange(len(limites) - 1), np.diff(limites))
+        return cls(pai=pai, geracao=geracao, limites=limites)
+
+    def __len__(self):
+        return len(self.pai)
+
+    def filhos(self):
+        return np.bincount(self.pai[1:], minlength=len(self.pai))
+
+    def tamanhos_geracoes(self):
+        return np.diff(self.limites)
+
+    def info(self):
+        filhos = self.filhos()
+        return (int(filhos[0]), int(filhos.max()), int(self.geracao[-1]),
+                float(self.geracao.mean()), len(self))
+
+def ramificacao(lamda, mu, tempo_maximo, rng):
+    # Periodo ocupado da M/M/1 como processo de Galton-Watson: o atendimento
+    # FIFO percorre a arvore em largura, entao cada geracao e sorteada de uma
+    # vez e a saida de cada no e a soma acumulada dos atendimentos.
+    pais = [np.array([-1])]
+    trabalho = 0.0
+    inicio = 0
+    atual = 1
+    while True:
+        servicos = rng.exponential(1/mu, atual)
+        saidas = trabalho + np.cumsum(servicos)
+        corte = np.searchsorted(saidas, tempo_maximo, side='left')
+        if corte < atual:
+            pais[-1] = pais[-1][:corte]
+            if corte > 0:
+                trabalho = saidas[corte - 1]
+            parou = False
+            break
+        trabalho = saidas[-1]
+        filhos = rng.poisson(lamda * servicos)
+        atual = int(filhos.sum())
+        if atual == 0:
+            parou = True
+            break
+        pais.append(np.repeat(np.arange(inicio, inicio + len(servicos)), filhos))
+        inicio += len(servicos)
+    pai = np.concatenate(pais)
+    if len(pai) == 0:
+        # a raiz nao saiu antes de tempo_maximo: ninguem saiu, a duracao
+        # observada e 0 e o periodo foi cortado, como em Servidor.gera_arvore
+        return Arvore.dos_pais(np.array([-1])), 0.0, False
+    return Arvore.dos_pais(pai), float(trabalho), parou
 
     
     
@@ -42,8 +630,28 @@ class Servidor:
     lamda: float
     mu: float
     tempo_maximo: float
-    arvore : list[Infectado] = field(default_factory=list)
-    processados: list[Cliente] = field(default_factory=list)
+    arvore : Optional[Arvore] = None
+    processados: Clientes = field(default_factory=Clientes)
+    rng: np.random.Generator = field(default_factory=np.random.default_rng)
+    acumuladores: Optional[Acumuladores] = None
+    distribuicao_chegada: Optional[object] = None
+    distribuicao_servico: Optional[object] = None
+    antitetico: bool = False
+    perfil: Optional[Perfil] = None
+    rastro: Optional[Rastro] = None
+
+    def __post_init__(self):
+        if self.distribuicao_chegada is None:
+            self.distribuicao_chegada = Exponencial(self.lamda)
+        if self.distribuicao_servico is None:
+            self.distribuicao_servico = Exponencial(self.mu)
+        # as chegadas usam o proprio rng e so o atendimento ganha um filho:
+        # criar cada Generator custa mais que um periodo ocupado curto inteiro
+        [rng_servico] = geradores_filhos(self.rng, 1)
+        self.amostrador_chegada = Amostrador(self.distribuicao_chegada, self.rng,
+                                             antitetico=self.antitetico)
+        self.amostrador_servico = Amostrador(self.distribuicao_servico, rng_servico,
+                                             antitetico=self.antitetico)
     
     def proximo_cliente(self, ultimo_cliente: Cliente) -> Cliente:
         chegada = ultimo_cliente.chegada + self.chegada_aleatoria()
@@ -51,28 +659,123 @@ class Servidor:
         return Cliente(chegada=chegada, atendido=atendido,
                        saida=atendido+self.tempo_de_processamento())
         
-    def run(self):
-        atual_cliente = Cliente(chegada=0, atendido=0,
-                                   saida=self.tempo_de_processamento())
-        while atual_cliente.saida < self.tempo_maximo:
-            self.processados.append(atual_cliente)
-            atual_cliente = self.proximo_cliente(atual_cliente)
+    def conta(self, nome, n=1):
+        if self.perfil is not None:
+            self.perfil.conta(nome, n)
+
+    def sorteios(self):
+        return self.amostrador_chegada.sorteios + self.amostrador_servico.sorteios
+
+    @medido('geracao')
+    def run(self, bloco=None):
+        for chegadas, atendidos, saidas in self.blocos(bloco):
+            self.processados.estende(chegadas, atendidos, saidas)
+
+    @medido('geracao')
+    def run_streaming(self, bloco=None):
+        if self.acumuladores is None:
+            self.acumuladores = Acumuladores()
+        for chegadas, atendidos, saidas in self.blocos(bloco):
+            self.acumuladores.adiciona(chegadas, atendidos, saidas)
+
+    def info_streaming(self, quantis=(0.5, 0.9, 0.99)):
+        acumuladores = self.acumuladores
+        mean_pessoas_area = acumuladores.pessoas_area / self.tempo_maximo
+        return (mean_pessoas_area, acumuladores.espera.media, acumuladores.espera.variancia(),
+                acumuladores.permanencia.quantil(quantis), acumuladores.max_no_sistema)
+
+    def como_rede(self, servidores=1, capacidade=None):
+        estacao = Estacao(servico=self.distribuicao_servico, servidores=servidores,
+                          capacidade=capacidade, chegadas=self.distribuicao_chegada)
+        return Rede(estacoes=[estacao], tempo_maximo=self.tempo_maximo, rng=self.rng)
+
+    def blocos(self, bloco=None, ultimo=None):
+        # ultimo = (chegada, saida) do ultimo cliente ja gerado, para continuar
+        if bloco is None:
+            bloco = min(int(self.lamda * self.tempo_maximo * 1.1) + 16, 1 << 16)
+        ultima_chegada, ultima_saida = ultimo if ultimo is not None else (0.0, 0.0)
+        primeiro = ultimo is None
+        while True:
+            intervalos = self.chegadas_aleatorias(bloco)
+            if primeiro:
+                intervalos[0] = 0.0
+                primeiro = False
+            chegadas = ultima_chegada + np.cumsum(intervalos)
+            atendidos, saidas = lindley(chegadas, self.tempos_de_processamento(bloco),
+                                        ultima_saida)
+            fim = np.searchsorted(saidas, self.tempo_maximo, side='left')
+            self.conta('clientes', fim)
+            if fim < bloco:
+                if fim > 0:
+                    yield chegadas[:fim], atendidos[:fim], saidas[:fim]
+                return
+            yield chegadas, atendidos, saidas
+            ultima_chegada = chegadas[-1]
+            ultima_saida = saidas[-1]
+
+    @medido('geracao')
+    def run_em_disco(self, diretorio, bloco=None, a_cada=16, tamanho_pedaco=1 << 22):
+        # Grava os clientes num Rastro em diretorio e, a cada a_cada blocos, um
+        # checkpoint com os amostradores (buffer e estado do gerador), o ultimo
+        # cliente e os acumuladores. Se ja existe checkpoint, continua dele e
+        # gera exatamente os mesmos clientes que a execucao sem interrupcao.
+        self.rastro = Rastro(diretorio, tamanho_pedaco)
+        checkpoint = os.path.join(diretorio, 'checkpoint.pkl')
+        ultimo = None
+        if os.path.exists(checkpoint):
+            with open(checkpoint, 'rb') as arquivo:
+                estado = pickle.load(arquivo)
+            self.amostrador_chegada = estado['amostrador_chegada']
+            self.amostrador_servico = estado['amostrador_servico']
+            self.acumuladores = estado['acumuladores']
+            self.rastro.trunca(estado['clientes'])
+            if estado['terminou']:
+                return
+            ultimo = estado['ultimo']
+        else:
+            # um rastro.json sem checkpoint e de uma execucao morta antes do
+            # primeiro checkpoint: nada do que esta no disco vale
+            self.rastro.trunca(0)
+        for i, (chegadas, atendidos, saidas) in enumerate(self.blocos(bloco, ultimo), 1):
+            self.rastro.estende(chegadas, atendidos, saidas)
+            if self.acumuladores is not None:
+                self.acumuladores.adiciona(chegadas, atendidos, saidas)
+            ultimo = (float(chegadas[-1]), float(saidas[-1]))
+            if i % a_cada == 0:
+                self.guarda_checkpoint(checkpoint, ultimo, terminou=False)
+        self.guarda_checkpoint(checkpoint, ultimo, terminou=True)
 
-    def run_until_empty(self, deterministic=False):
+    def guarda_checkpoint(self, caminho, ultimo, terminou):
+        # o indice do rastro vai antes, entao o checkpoint nunca aponta para
+        # clientes que nao chegaram ao disco
+        self.rastro.descarrega()
+        estado = dict(amostrador_chegada=self.amostrador_chegada,
+                      amostrador_servico=self.amostrador_servico,
+                      acumuladores=self.acumuladores, ultimo=ultimo,
+                      clientes=len(self.rastro), terminou=terminou)
+        with open(caminho + '.tmp', 'wb') as arquivo:
+            pickle.dump(estado, arquivo)
+        os.replace(caminho + '.tmp', caminho)
+
+    @medido('geracao')
+    def run_until_empty(self):
         atual_cliente = Cliente(chegada=0, atendido=0,
                                 saida=self.tempo_de_processamento())
         while atual_cliente.saida < self.tempo_maximo:
             self.processados.append(atual_cliente)
-            if not (atual_cliente := self.proximo_cliente_ou_vazio(atual_cliente, deterministic=deterministic)):
+            self.conta('clientes')
+            if not (atual_cliente := self.proximo_cliente_ou_vazio(atual_cliente)):
                 return True
         return False
 
+    @medido('geracao')
     def run_with_max_clientes_until_empty(self, max_clientes):
         atual_cliente = Cliente(chegada=0, atendido=0,
                                 saida=self.tempo_de_processamento())
         clientes_na_fila = 0
         while True:
             self.processados.append(atual_cliente)
+            self.conta('clientes')
             if not (atual_cliente := self.proximo_cliente_ou_vazio(atual_cliente)):
                 return True
             if atual_cliente.atendido > atual_cliente.chegada:
@@ -84,30 +787,42 @@ class Servidor:
             prox_cliente = atual_cliente
         
 
-    def proximo_cliente_ou_vazio(self, ultimo_cliente, deterministic=False):
-        delta = self.chegada_aleatoria() if deterministic else 1/self.mu
-        chegada = ultimo_cliente.chegada + delta
+    def proximo_cliente_ou_vazio(self, ultimo_cliente):
+        chegada = ultimo_cliente.chegada + self.chegada_aleatoria()
         if chegada < ultimo_cliente.saida:
             atendido = ultimo_cliente.saida
             return Cliente(chegada=chegada, atendido=ultimo_cliente.saida,
                            saida=atendido+self.tempo_de_processamento())
     
     def chegada_aleatoria(self):
-        return random.exponential(1/self.lamda)
+        return self.amostrador_chegada()
 
     def tempo_de_processamento(self):
-        return random.exponential(1/self.mu)
+        return self.amostrador_servico()
+
+    def chegadas_aleatorias(self, n):
+        return self.amostrador_chegada.amostras(n)
 
+    def tempos_de_processamento(self, n):
+        return self.amostrador_servico.amostras(n)
+
+    @medido('eventos')
     def eventos(self):            
         eventos = []
         
-        for cliente in self.processados:
-            eventos.append(Evento(EventoTipo.Entrada, cliente.chegada))
-            eventos.append(Evento(EventoTipo.Saida, cliente.saida))
-            eventos.append(Evento(EventoTipo.Atendido, cliente.atendido))
+        for chegada, atendido, saida in zip(self.processados.chegada.tolist(),
+                                            self.processados.atendido.tolist(),
+                                            self.processados.saida.tolist()):
+            eventos.append(Evento(EventoTipo.Entrada, chegada))
+            eventos.append(Evento(EventoTipo.Saida, saida))
+            eventos.append(Evento(EventoTipo.Atendido, atendido))
+        self.conta('eventos', len(eventos))
         return sorted(eventos, key=lambda evento: evento.tempo)
     
+    @medido('reducao')
     def info_clientes(self):
+        if self.rastro is not None:
+            return self.rastro.info_clientes(self.tempo_maximo)
         na_fila = 0
         curr_time = 0
         waiting_time = 0
@@ -122,79 +837,60 @@ class Servidor:
                     na_fila -= 1
                 case EventoTipo.Entrada:
                     na_fila += 1
-        waiting_time = sum(cliente.atendido - cliente.chegada for cliente in self.processados)
+        waiting_time = np.sum(self.processados.atendido - self.processados.chegada)
         mean_waiting_time = waiting_time / len(self.processados)
         mean_pessoas_area = pessoas_area / self.tempo_maximo
         return mean_pessoas_area, mean_waiting_time, cdf_pessoas
+
+    @medido('reducao')
+    def info_clientes_linear(self):
+        if self.rastro is not None:
+            return self.rastro.info_clientes(self.tempo_maximo)
+        tempos, variacao = mescla_eventos(self.processados.chegada, self.processados.saida)
+        na_fila = np.cumsum(variacao) - variacao
+        pessoas_area = np.cumsum(na_fila * np.diff(tempos, prepend=0.0))
+        cdf_pessoas = np.column_stack((pessoas_area, tempos))
+        waiting_time = np.sum(self.processados.atendido - self.processados.chegada)
+        mean_waiting_time = waiting_time / len(self.processados)
+        mean_pessoas_area = pessoas_area[-1] / self.tempo_maximo
+        return mean_pessoas_area, mean_waiting_time, cdf_pessoas
     
+    @medido('arvore')
     def gera_arvore(self):
-        atual_infectado = Infectado(geracao=0,
-                                    filhos=[])
-        atual_fila = [atual_infectado]
-        self.arvore = [atual_infectado]
-        eventos_str = ''
-        for evento in self.eventos()[1:]:
-            match evento.tipo:
-                case EventoTipo.Entrada:
-                    eventos_str += 'e'
-                    novo_infectado = Infectado(geracao=atual_infectado.geracao+1,
-                                               filhos=[])
-                    self.arvore.append(novo_infectado)
-                    atual_infectado.adicionar_filho(novo_infectado)
-                    atual_fila.append(novo_infectado)
-                case EventoTipo.Saida:
-                    eventos_str += 's'
-                    if len(atual_fila) == 1:
-                        return evento.tempo
-                    else:
-                        atual_fila = atual_fila[1:]
-                        atual_infectado = atual_fila[0]
-
-                    
-        
+        chegadas = self.processados.chegada
+        saidas = self.processados.saida
+        if len(chegadas) == 0:
+            self.arvore = Arvore.da_fila(np.zeros(1), np.zeros(1))
+            return 0.0
+        # o periodo ocupado acaba na primeira saida antes da proxima chegada
+        vazios = np.flatnonzero(chegadas[1:] >= saidas[:-1])
+        fim = vazios[0] + 1 if len(vazios) else len(chegadas)
+        self.arvore = Arvore.da_fila(chegadas[:fim], saidas[:fim])
+        self.conta('nos_arvore', fim)
+        return float(saidas[fim - 1])
 
+    @medido('reducao')
     def info_arvore(self,show=False):
-        tamanhos_geracoes = []
-        atual_geracao = 0
-        tamanho_atual = 0
-        max_filhos = 0
-        filhos_raiz = len(self.arvore[0].filhos)
-        soma_alturas = 0
-        for infectado in self.arvore:
-            soma_alturas += infectado.geracao
-            max_filhos = max(len(infectado.filhos), max_filhos)
-            if infectado.geracao == atual_geracao:
-                tamanho_atual += 1
-            else:
-                tamanhos_geracoes.append(tamanho_atual)
-                tamanho_atual = 1
-        media_alturas = soma_alturas/len(self.arvore)
+        filhos_raiz, max_filhos, altura, media_alturas, _ = self.arvore.info()
         if show:
             print(f"filhos da raiz: {filhos_raiz}")
             print(f"max_filhos: {max_filhos}")
-            print(f"altura: {self.arvore[-1].geracao}")
+            print(f"altura: {altura}")
             print(f"media_alturas: {media_alturas}")
             print(f"numero de infectados: {len(self.arvore)}")
-        return filhos_raiz, max_filhos, self.arvore[-1].geracao, media_alturas, len(self.arvore)
+            print(f"tamanhos das geracoes: {self.arvore.tamanhos_geracoes().tolist()}")
+        return filhos_raiz, max_filhos, altura, media_alturas, len(self.arvore)
     
-    def print_arvore(self, no : Infectado):
-        if no.geracao == 20:
-            print(f"{no.geracao*' '} filhos: {len(no.filhos)} (filhos omitidos)")
-        elif no.filhos == []:
-            print(f"{no.geracao*' '} filhos: {len(no.filhos)}")
+    def print_arvore(self, no=0):
+        geracao = self.arvore.geracao[no]
+        inicio, fim = np.searchsorted(self.arvore.pai, [no, no + 1], side='left')
+        if geracao == 20:
+            print(f"{geracao*' '} filhos: {fim - inicio} (filhos omitidos)")
         else:
-            print(f"{no.geracao*' '} filhos: {len(no.filhos)}")
-            for filho in no.filhos:
+            print(f"{geracao*' '} filhos: {fim - inicio}")
+            for filho in range(inicio, fim):
                 self.print_arvore(filho)
 
-        
-
-
-    
-
-        
-        
-        
     # def plot(self):
     #     [x, y] = list(zip(*points))
     #     fig = plt.figure(figsize=(10, 5))
@@ -208,89 +904,730 @@ class Servidor:
 
     #     plt.show()
 
-def gera_cdfs(lamda, mu, tempo_maximo=100):
-    serv = Servidor(lamda=lamda, mu=mu, tempo_maximo=tempo_maximo)
-    serv.run()
-    _, _, cdf = serv.info_clientes()
-    [tempo, pessoas] = list(zip(*cdf))
+@dataclass
+class Estacao:
+    servico: object
+    servidores: int = 1
+    # maximo de clientes na estacao (fila + atendimento); quem chega com ela
+    # cheia e perdido
+    capacidade: Optional[int] = None
+    # probabilidade de ir para cada estacao ao sair; o que sobra deixa a rede
+    roteamento: tuple[float, ...] = ()
+    chegadas: Optional[object] = None
+
+class Calendario:
+    # heap binario de eventos; o contador desempata eventos no mesmo tempo
+    # na ordem em que foram agendados
+    def __init__(self):
+        self.heap = []
+        self.contador = 0
+
+    def agenda(self, evento: Evento):
+        heapq.heappush(self.heap, (evento.tempo, self.contador, evento))
+        self.contador += 1
+
+    def proximo(self) -> Evento:
+        return heapq.heappop(self.heap)[2]
+
+    def __len__(self):
+        return len(self.heap)
+
+@dataclass
+class Rede:
+    estacoes: list[Estacao]
+    tempo_maximo: float
+    rng: np.random.Generator = field(default_factory=np.random.default_rng)
+
+    def __post_init__(self):
+        geradores = geradores_filhos(self.rng, 2 * len(self.estacoes) + 1)
+        self.amostradores_servico = [Amostrador(estacao.servico, rng)
+                                     for estacao, rng in zip(self.estacoes, geradores)]
+        self.amostradores_chegada = [Amostrador(estacao.chegadas, rng)
+                                     if estacao.chegadas is not None else None
+                                     for estacao, rng in zip(self.estacoes, geradores[len(self.estacoes):])]
+        self.roteamento = Amostrador(Uniforme(0, 1), geradores[-1])
+        self.acumulado_roteamento = [np.cumsum(estacao.roteamento) for estacao in self.estacoes]
+        self.visitas = [Clientes() for _ in self.estacoes]
+        self.perdidos = [0] * len(self.estacoes)
+        self.fila = [deque() for _ in self.estacoes]
+        self.ocupados = [0] * len(self.estacoes)
+        self.no_sistema = [0] * len(self.estacoes)
+        self.calendario = Calendario()
+
+    def run(self):
+        for i, amostrador in enumerate(self.amostradores_chegada):
+            if amostrador is not None:
+                self.calendario.agenda(Evento(EventoTipo.Entrada, 0.0, i))
+        while self.calendario:
+            evento = self.calendario.proximo()
+            if evento.tempo >= self.tempo_maximo:
+                break
+            match evento.tipo:
+                case EventoTipo.Entrada:
+                    self.calendario.agenda(Evento(EventoTipo.Entrada,
+                                                  evento.tempo + self.amostradores_chegada[evento.estacao](),
+                                                  evento.estacao))
+                    self.chega(evento.estacao, evento.tempo)
+                case EventoTipo.Saida:
+                    self.sai(evento.estacao, evento.cliente, evento.tempo)
+
+    def chega(self, estacao, tempo):
+        capacidade = self.estacoes[estacao].capacidade
+        if capacidade is not None and self.no_sistema[estacao] >= capacidade:
+            self.perdidos[estacao] += 1
+            return
+        visita = len(self.visitas[estacao])
+        self.visitas[estacao].append(Cliente(chegada=tempo, atendido=np.nan, saida=np.nan))
+        self.no_sistema[estacao] += 1
+        if self.ocupados[estacao] < self.estacoes[estacao].servidores:
+            self.atende(estacao, visita, tempo)
+        else:
+            self.fila[estacao].append(visita)
+
+    def atende(self, estacao, visita, tempo):
+        self.visitas[estacao].atendido[visita] = tempo
+        self.ocupados[estacao] += 1
+        self.calendario.agenda(Evento(EventoTipo.Saida,
+                                      tempo + self.amostradores_servico[estacao](),
+                                      estacao, visita))
+
+    def sai(self, estacao, visita, tempo):
+        self.visitas[estacao].saida[visita] = tempo
+        self.ocupados[estacao] -= 1
+        self.no_sistema[estacao] -= 1
+        if self.fila[estacao]:
+            self.atende(estacao, self.fila[estacao].popleft(), tempo)
+        acumulado = self.acumulado_roteamento[estacao]
+        if len(acumulado):
+            destino = int(np.searchsorted(acumulado, self.roteamento(), side='right'))
+            if destino < len(acumulado):
+                self.chega(destino, tempo)
+
+    def info_estacoes(self):
+        resultados = []
+        for visitas, perdidos in zip(self.visitas, self.perdidos):
+            # quem ainda nao saiu conta ate tempo_maximo
+            saidas = np.fmin(visitas.saida, self.tempo_maximo)
+            atendidos = np.fmin(visitas.atendido, self.tempo_maximo)
+            pessoas_area = np.sum(saidas - visitas.chegada)
+            espera = np.mean(atendidos - visitas.chegada) if len(visitas) else 0.0
+            tentativas = len(visitas) + perdidos
+            perda = perdidos / tentativas if tentativas else 0.0
+            resultados.append((pessoas_area / self.tempo_maximo, espera, perda))
+        return resultados
+
+def reduz_pontos(x, y, pontos=2000):
+    # Decimacao min/max: divide x (ordenado) em pontos faixas iguais e guarda
+    # de cada uma o primeiro, o ultimo, o menor e o maior ponto, entao o
+    # desenho mantem os picos com no maximo 4 * pontos pontos.
+    if len(x) <= 4 * pontos:
+        return x, y
+    largura = (x[-1] - x[0]) / pontos or 1.0
+    faixa = np.minimum(((x - x[0]) / largura).astype(np.int64), pontos - 1)
+    inicios = np.flatnonzero(np.diff(faixa, prepend=-1))
+    fins = np.append(inicios[1:], len(x)) - 1
+    ordem = np.lexsort((y, faixa))
+    escolhidos = np.unique(np.concatenate((inicios, fins, ordem[inicios], ordem[fins])))
+    return x[escolhidos], y[escolhidos]
+
+def reduz_pedacos(pedacos, pontos=2000):
+    # reduz_pontos sobre uma curva que chega em pedacos consecutivos
+    xs, ys = np.empty(0), np.empty(0)
+    for x, y in pedacos:
+        x, y = reduz_pontos(x, y, pontos)
+        xs, ys = reduz_pontos(np.concatenate((xs, x)), np.concatenate((ys, y)), pontos)
+    return xs, ys
+
+def gera_cdfs(lamda, mu, tempo_maximo=100, rastro=None, pontos=2000, exporta=None):
+    # As curvas saem de somas acumuladas sobre as colunas (com um Rastro de
+    # run_em_disco, pedaco a pedaco) e sao reduzidas por reduz_pontos. Com
+    # exporta, grava as curvas num .npz em vez de desenhar o PNG.
+    if rastro is None:
+        serv = Servidor(lamda=lamda, mu=mu, tempo_maximo=tempo_maximo)
+        serv.run()
+        _, _, cdf = serv.info_clientes_linear()
+        pessoas = reduz_pontos(cdf[:, 1], cdf[:, 0], pontos)
+        permanencias = np.cumsum(serv.processados.saida - serv.processados.chegada)
+        espera = reduz_pontos(np.arange(len(permanencias)), permanencias, pontos)
+    else:
+        _, _, cdf = rastro.info_clientes(tempo_maximo)
+        pessoas = reduz_pedacos(((pedaco[:, 1], pedaco[:, 0]) for pedaco in cdf), pontos)
+        espera = reduz_pedacos(rastro.permanencias_acumuladas(), pontos)
+    if exporta is not None:
+        np.savez(exporta, pessoas_tempo=pessoas[0], pessoas_area=pessoas[1],
+                 espera_cliente=espera[0], espera_acumulada=espera[1])
+        return pessoas, espera
+
+    from matplotlib import pyplot as plt
     fig = plt.figure(figsize=(10, 5))
     
     fig.suptitle(f"M/M/1 ($\\lambda$ = {lamda}, $\\mu$ = {mu})")
-    [clientes, espera] = fig.subplots(2, 1)
+    [clientes, espera_eixo] = fig.subplots(2, 1)
     clientes.set_title("Cdf do número de clientes")
-    clientes.plot(tempo, pessoas)
-
-    x = range(len(serv.processados))
-    y = []
-    soma = 0
-    for cliente in serv.processados:
-        soma += cliente.saida - cliente.chegada
-        y.append(soma)
-    espera.set_title("Cdf do tempo de espera")
-    espera.plot(x, y)
+    clientes.plot(*pessoas)
+    espera_eixo.set_title("Cdf do tempo de espera")
+    espera_eixo.plot(*espera)
 
     fig.tight_layout()
     plt.savefig(f"m_m_1_queue_lambda_{lamda}_mu_{mu}.png")
+    plt.close(fig)
+    return pessoas, espera
     
+
+def roda_replica(replica, parametros, semente, perfilar=False):
+    if perfilar:
+        perfil = Perfil()
+        return replica(np.random.default_rng(semente), perfil=perfil, **parametros), perfil
+    return replica(np.random.default_rng(semente), **parametros)
+
+def pool(workers):
+    # um unico pool para varias chamadas de executa_sementes; com um worker
+    # tudo roda no processo atual
+    if workers == 1:
+        return nullcontext()
+    return ProcessPoolExecutor(max_workers=workers)
+
+def executa_sementes(replica, sementes, workers=None, perfil=None, executor=None, **parametros):
+    # com um Perfil, cada replicacao mede o seu e eles sao somados nele; um
+    # executor aberto por quem chama e reaproveitado em vez de abrir outro
+    tarefa = partial(roda_replica, replica, parametros, perfilar=perfil is not None)
+    workers = workers or os.cpu_count()
+    if workers == 1:
+        resultados = list(map(tarefa, sementes))
+    else:
+        with nullcontext(executor) if executor is not None else pool(workers) as executor:
+            resultados = list(executor.map(tarefa, sementes,
+                                           chunksize=max(1, len(sementes) // (4 * workers))))
+    if perfil is None:
+        return resultados
+    for _, perfil_replica in resultados:
+        perfil.junta(perfil_replica)
+    perfil.conta('replicacoes', len(resultados))
+    return [resultado for resultado, _ in resultados]
+
+def executa_replicacoes(replica, n, workers=None, seed=None, perfil=None, **parametros):
+    # Cada replicacao tem o seu proprio Generator, derivado da semente mestre
+    # pelo seu indice, entao o resultado nao depende de quantos workers rodam.
+    sementes = np.random.SeedSequence(seed).spawn(n)
+    return executa_sementes(replica, sementes, workers=workers, perfil=perfil, **parametros)
+
+def distribuicao_t(t, gl):
+    # P(T <= t) para gl inteiro pela serie fechada (Abramowitz & Stegun 26.7)
+    theta = math.atan2(abs(t), math.sqrt(gl))
+    cos2 = math.cos(theta) ** 2
+    if gl % 2 == 1:
+        soma = 0.0
+        if gl > 1:
+            soma = termo = math.cos(theta)
+            for k in range(3, gl - 1, 2):
+                termo *= cos2 * (k - 1) / k
+                soma += termo
+        a = 2 / math.pi * (theta + math.sin(theta) * soma)
+    else:
+        termo = soma = 1.0
+        for k in range(2, gl - 1, 2):
+            termo *= cos2 * (k - 1) / k
+            soma += termo
+        a = math.sin(theta) * soma
+    return 0.5 + math.copysign(a / 2, t)
+
+def quantil_t(p, gl):
+    if gl > 1000:
+        return NormalDist().inv_cdf(p)
+    if p < 0.5:
+        return -quantil_t(1 - p, gl)
+    # bissecao no angulo theta = atan(t / sqrt(gl)), que fica em [0, pi/2)
+    baixo, alto = 0.0, math.pi / 2
+    for _ in range(60):
+        meio = (baixo + alto) / 2
+        if distribuicao_t(math.sqrt(gl) * math.tan(meio), gl) < p:
+            baixo = meio
+        else:
+            alto = meio
+    return math.sqrt(gl) * math.tan((baixo + alto) / 2)
+
+def media_desvio_padrao(l, nivel=0.95):
+    media = np.mean(l)
+    desvio = np.std(l, ddof=1)
+    confianca = quantil_t((1 + nivel) / 2, len(l) - 1) * (desvio / np.sqrt(len(l)))
+    return media, desvio, confianca 
+
+def estimador_controle(y, controles, esperancas, nivel=0.95):
+    # Variaveis de controle: corrige a media de y pela regressao nos
+    # controles, cujas esperancas sao conhecidas, e usa o residuo no intervalo.
+    y = np.asarray(y, dtype=float)
+    controles = np.asarray(controles, dtype=float).reshape(len(y), -1)
+    centrados = controles - controles.mean(axis=0)
+    beta = np.linalg.lstsq(centrados, y - y.mean(), rcond=None)[0]
+    media = y.mean() - (controles.mean(axis=0) - np.asarray(esperancas)) @ beta
+    residuos = y - y.mean() - centrados @ beta
+    gl = len(y) - controles.shape[1] - 1
+    desvio = np.sqrt(np.sum(residuos ** 2) / gl)
+    confianca = quantil_t((1 + nivel) / 2, gl) * desvio / np.sqrt(len(y))
+    return media, desvio, confianca
+
+def replicacoes_sequenciais(replica, precisao_relativa=None, precisao_absoluta=None, lote=100,
+                            maximo=100000, nivel=0.95, workers=None, seed=None, perfil=None,
+                            **parametros):
+    # Roda lotes de replicacoes ate a meia largura do intervalo de confianca de
+    # todas as metricas ficar abaixo do alvo, ou ate esgotar o orcamento.
+    semente = np.random.SeedSequence(seed)
+    resultados = []
+    workers = workers or os.cpu_count()
+    with pool(workers) as executor:
+        while len(resultados) < maximo:
+            n = min(lote, maximo - len(resultados))
+            resultados += executa_sementes(replica, semente.spawn(n), workers=workers,
+                                           perfil=perfil, executor=executor, **parametros)
+            dados = np.array(resultados, dtype=float).reshape(len(resultados), -1)
+            if len(dados) < 2:
+                continue
+            desvios = dados.std(axis=0, ddof=1)
+            confiancas = quantil_t((1 + nivel) / 2, len(dados) - 1) * desvios / np.sqrt(len(dados))
+            alvos = np.zeros(dados.shape[1])
+            if precisao_relativa is not None:
+                alvos = np.maximum(alvos, precisao_relativa * np.abs(dados.mean(axis=0)))
+            if precisao_absoluta is not None:
+                alvos = np.maximum(alvos, precisao_absoluta)
+            if np.all(np.nan_to_num(confiancas) <= alvos):
+                break
+    return resultados
+
+def compara_casos(replica, casos, n=1000, seed=None, antitetico=False, workers=None):
+    # Numeros aleatorios comuns: a replicacao i de todos os casos usa a mesma
+    # semente, e como as variaveis saem por transformada inversa das mesmas
+    # uniformes os casos ficam positivamente correlacionados. Com antitetico,
+    # cada semente tambem roda com 1 - u e o par e tirado a media. Cada
+    # chamada recebe copias novas das sementes, pelo mesmo motivo de
+    # geradores_filhos.
+    entropia = np.random.SeedSequence(seed).entropy
+    sementes = lambda: np.random.SeedSequence(entropia).spawn(n)
+    resultados = []
+    for caso in casos:
+        dados = np.array(executa_sementes(replica, sementes(), workers=workers, **caso),
+                         dtype=float).reshape(n, -1)
+        if antitetico:
+            espelho = np.array(executa_sementes(replica, sementes(), workers=workers,
+                                                antitetico=True, **caso),
+                               dtype=float).reshape(n, -1)
+            variancia_simples = np.concatenate((dados, espelho)).var(axis=0, ddof=1)
+            dados = (dados + espelho) / 2
+            fator = variancia_simples / 2 / dados.var(axis=0, ddof=1)
+            print(f"{caso}: redução de variância antitética {np.round(fator, 2).tolist()}")
+        resultados.append(dados)
+    diferencas = []
+    for caso, dados in zip(casos[1:], resultados[1:]):
+        diferenca = dados - resultados[0]
+        fator = ((resultados[0].var(axis=0, ddof=1) + dados.var(axis=0, ddof=1))
+                 / diferenca.var(axis=0, ddof=1))
+        estatisticas = list(map(media_desvio_padrao, diferenca.T))
+        for (media, desvio, confianca), f in zip(estatisticas, fator):
+            print(f"{caso} - {casos[0]}: {media:.4f} (±{confianca:.4f} @ 95%), "
+                  f"redução de variância por números comuns {f:.2f}")
+        diferencas.append((estatisticas, fator))
+    return resultados, diferencas
+
+def truncamento_mser(serie, tamanho=5):
+    # MSER-5: escolhe quantos lotes de 5 descartar do inicio minimizando o
+    # erro padrao do que sobra, olhando so a primeira metade da serie
+    lotes = serie[:len(serie) // tamanho * tamanho].reshape(-1, tamanho).mean(axis=1)
+    restantes = np.arange(len(lotes), 0, -1)
+    soma = np.cumsum(lotes[::-1])[::-1]
+    soma_quadrados = np.cumsum((lotes ** 2)[::-1])[::-1]
+    mser = (soma_quadrados - soma ** 2 / restantes) / restantes ** 2
+    return int(np.argmin(mser[:max(1, len(lotes) // 2)])) * tamanho
+
+def medias_em_lotes(serie, min_lotes=20, max_correlacao=0.1, nivel=0.95):
+    # dobra o tamanho do lote ate a autocorrelacao de lag 1 das medias dos
+    # lotes ficar pequena ou sobrarem so min_lotes lotes
+    tamanho = max(1, len(serie) // 4096)
+    while True:
+        n_lotes = len(serie) // tamanho
+        lotes = serie[len(serie) - n_lotes * tamanho:].reshape(n_lotes, tamanho).mean(axis=1)
+        centrados = lotes - lotes.mean()
+        correlacao = np.sum(centrados[1:] * centrados[:-1]) / np.sum(centrados ** 2)
+        if correlacao <= max_correlacao or n_lotes < 4 * min_lotes:
+            break
+        tamanho *= 2
+    return media_desvio_padrao(lotes, nivel=nivel)
+
+def replica_servidor(rng, lamda, mu, tempo_maximo, antitetico=False, controles=False,
+                     perfil=None):
+    serv = Servidor(lamda=lamda, mu=mu, tempo_maximo=tempo_maximo, rng=rng,
+                    antitetico=antitetico, perfil=perfil)
+    if controles:
+        # medias dos primeiros k atendimentos e intervalos sorteados, com k
+        # fixo em torno do numero esperado de clientes: o corte em
+        # tempo_maximo nao escolhe quais valores entram, entao as esperancas
+        # sao exatamente 1/mu e 1/lamda
+        k = max(1, round(lamda * tempo_maximo))
+        media_servico = serv.amostrador_servico.espia(k).mean()
+        media_intervalo = serv.amostrador_chegada.espia(k).mean()
+    serv.run()
+    numero_medio_clientes, tempo_medio_espera, _ = serv.info_clientes_linear()
+    if controles:
+        return numero_medio_clientes, tempo_medio_espera, media_servico, media_intervalo
+    return numero_medio_clientes, tempo_medio_espera
+
+def replica_terminacao(rng, lamda, mu, tempo_maximo, antitetico=False, perfil=None):
+    serv = Servidor(lamda=lamda, mu=mu, tempo_maximo=tempo_maximo, rng=rng,
+                    antitetico=antitetico, perfil=perfil)
+    return serv.run_until_empty()
+
+def replica_terminacao_com_max_clientes(rng, lamda, mu, max_clientes, tempo_maximo, perfil=None):
+    serv = Servidor(lamda=lamda, mu=mu, tempo_maximo=tempo_maximo, rng=rng, perfil=perfil)
+    return serv.run_with_max_clientes_until_empty(max_clientes)
+
+def replica_epidemia(rng, lamda, mu, tempo_maximo, deterministic, antitetico=False, perfil=None):
+    chegada = Deterministica(1/mu) if deterministic else None
+    serv = Servidor(lamda=lamda, mu=mu, tempo_maximo=tempo_maximo, rng=rng,
+                    distribuicao_chegada=chegada, antitetico=antitetico, perfil=perfil)
+    parou = serv.run_until_empty()
+    ultima_saida = serv.gera_arvore()
+    info_arvore = serv.info_arvore()
+    #serv.print_arvore()
+    return (*info_arvore, ultima_saida, parou)
+
+def replica_ramificacao(rng, lamda, mu, tempo_maximo, perfil=None):
+    if perfil is None:
+        arvore, ultima_saida, parou = ramificacao(lamda, mu, tempo_maximo, rng)
+        return (*arvore.info(), ultima_saida, parou)
+    with perfil.fase('arvore'):
+        arvore, ultima_saida, parou = ramificacao(lamda, mu, tempo_maximo, rng)
+    perfil.conta('nos_arvore', len(arvore))
+    with perfil.fase('reducao'):
+        return (*arvore.info(), ultima_saida, parou)
     
-def simula_servidores(lamda, mu, tempo_maximo=100):
-    medias = []
+REPLICAS = {
+    'servidores': replica_servidor,
+    'terminacoes': replica_terminacao,
+    'terminacoes_com_max_clientes': replica_terminacao_com_max_clientes,
+    'epidemias': replica_epidemia,
+    'ramificacao': replica_ramificacao,
+}
+
+@dataclass
+class Cache:
+    # Resultados por replicacao guardados em .npy, endereçados pelo hash dos
+    # parametros, da semente e da versao do motor. O mtime marca o ultimo
+    # uso e os arquivos mais antigos saem quando o total passa do limite.
+    diretorio: str = os.path.expanduser('~/.cache/filas')
+    tamanho_maximo: int = 1 << 30
+
+    def chave(self, tipo, parametros, seed):
+        # 1 e 1.0 sao o mesmo ponto da grade
+        parametros = {nome: float(valor) if isinstance(valor, (int, float))
+                      and not isinstance(valor, bool) else valor
+                      for nome, valor in parametros.items()}
+        texto = json.dumps(dict(tipo=tipo, parametros=parametros, seed=seed,
+                                versao=VERSAO_MOTOR), sort_keys=True)
+        return hashlib.sha256(texto.encode()).hexdigest()
+
+    def caminho(self, chave):
+        return os.path.join(self.diretorio, chave + '.npy')
+
+    def carrega(self, chave):
+        caminho = self.caminho(chave)
+        if not os.path.exists(caminho):
+            return None
+        os.utime(caminho)
+        return np.load(caminho)
+
+    def guarda(self, chave, dados):
+        os.makedirs(self.diretorio, exist_ok=True)
+        temporario = self.caminho(chave) + '.tmp'
+        with open(temporario, 'wb') as arquivo:
+            np.save(arquivo, dados)
+        os.replace(temporario, self.caminho(chave))
+        self.despeja()
+
+    def despeja(self):
+        arquivos = [os.path.join(self.diretorio, nome) for nome in os.listdir(self.diretorio)
+                    if nome.endswith('.npy')]
+        estados = sorted((os.stat(arquivo).st_mtime, os.stat(arquivo).st_size, arquivo)
+                         for arquivo in arquivos)
+        total = sum(tamanho for _, tamanho, _ in estados)
+        for _, tamanho, arquivo in estados[:-1]:
+            if total <= self.tamanho_maximo:
+                break
+            os.remove(arquivo)
+            total -= tamanho
+
+def varredura(tipo, grade, replicacoes, seed=0, cache=None, workers=None):
+    # Roda todos os pontos do produto da grade (ex.: {'lamda': [...], 'mu': [...],
+    # 'tempo_maximo': [...]}) e so simula as replicacoes que faltam no cache.
+    # A replicacao i usa sempre o filho i da SeedSequence(seed), como em
+    # executa_replicacoes, entao aumentar `replicacoes` estende os resultados.
+    if cache is None:
+        cache = Cache()
+    replica = REPLICAS[tipo]
+    nomes = sorted(grade)
+    resultados = {}
+    for valores in itertools.product(*(grade[nome] for nome in nomes)):
+        parametros = dict(zip(nomes, valores))
+        chave = cache.chave(tipo, parametros, seed)
+        dados = cache.carrega(chave)
+        guardadas = 0 if dados is None else len(dados)
+        if guardadas < replicacoes:
+            sementes = [np.random.SeedSequence(seed, spawn_key=(i,))
+                        for i in range(guardadas, replicacoes)]
+            novos = np.array(executa_sementes(replica, sementes, workers=workers, **parametros),
+                             dtype=float).reshape(len(sementes), -1)
+            dados = novos if dados is None else np.concatenate((dados, novos))
+            cache.guarda(chave, dados)
+        print(f"{tipo} {parametros}: {min(guardadas, replicacoes)} replicações do cache, "
+              f"{max(0, replicacoes - guardadas)} novas")
+        resultados[valores] = dados[:replicacoes]
+    return resultados
+
+def simula_servidores(lamda, mu, tempo_maximo=100, workers=None, seed=None, precisao=None,
+                      controle=False, perfil=False, mostra=True):
     rho = lamda/mu
-    for n in range(100):
-        serv = Servidor(lamda=lamda, mu=mu, tempo_maximo=tempo_maximo)
-        serv.run()
-        numero_medio_clientes, tempo_medio_espera, _ = serv.info_clientes()
-        medias.append((numero_medio_clientes, tempo_medio_espera))
-    def media_desvio_padrao(l):
-        media = np.mean(l)
-        desvio = np.std(l)
-        confianca = 1.984 * (desvio / np.sqrt(len(l)))
-        return media, desvio, confianca 
-    [[c_media, c_desvio_padrao, c_confianca], [e_media, e_desvio_padrao, e_confianca]] = list(map(media_desvio_padrao, zip(*medias)))
+    perfil = Perfil() if perfil else None
+    if precisao is not None:
+        medias = replicacoes_sequenciais(replica_servidor, precisao_relativa=precisao, lote=20,
+                                         workers=workers, seed=seed, perfil=perfil,
+                                         controles=controle,
+                                         lamda=lamda, mu=mu, tempo_maximo=tempo_maximo)
+    else:
+        medias = executa_replicacoes(replica_servidor, 100, workers=workers, seed=seed,
+                                     perfil=perfil, controles=controle,
+                                     lamda=lamda, mu=mu, tempo_maximo=tempo_maximo)
+    if controle:
+        dados = np.array(medias)
+        [[c_media, c_desvio_padrao, c_confianca], [e_media, e_desvio_padrao, e_confianca]] = [
+            estimador_controle(dados[:, i], dados[:, 2:], [1/mu, 1/lamda]) for i in range(2)]
+    else:
+        [[c_media, c_desvio_padrao, c_confianca], [e_media, e_desvio_padrao, e_confianca]] = list(map(media_desvio_padrao, zip(*medias)))
     
+    resultado = dict(replicacoes=len(medias),
+                     clientes_media=c_media, clientes_desvio=c_desvio_padrao,
+                     clientes_confianca=c_confianca, clientes_teorico=rho/(1-rho),
+                     espera_media=e_media, espera_desvio=e_desvio_padrao,
+                     espera_confianca=e_confianca, espera_teorico=rho / (mu - lamda))
+    if perfil is not None:
+        resultado.update(perfil.resumo())
+    if mostra:
+        if precisao is not None:
+            print(f"Replicações necessárias: {len(medias)}")
+        print(f"Média de clientes {c_media:.2f} (±{c_confianca:.2f} @ 95%) (teorico: {rho/(1-rho):.2f}), desvio padrão {c_desvio_padrao:.2f}")
+        print(f"Tempo médio de espera: {e_media:.2f} (±{e_confianca:.2f} @ 95%) (teorico: {rho / (mu - lamda):.2f}) desvio padrão {e_desvio_padrao:.2f}")
+        if perfil is not None:
+            print(perfil.relatorio())
+    return resultado
+
+def simula_servidor_longo(lamda, mu, tempo_maximo=100000, seed=None, janelas=1 << 16):
+    rho = lamda/mu
+    serv = Servidor(lamda=lamda, mu=mu, tempo_maximo=tempo_maximo,
+                    rng=np.random.default_rng(seed))
+    serv.run()
+    chegadas = serv.processados.chegada
+    saidas = serv.processados.saida
+    # numero no sistema como media em janelas de tempo iguais
+    bordas = np.linspace(0, saidas[-1], min(janelas, len(chegadas)) + 1)
+    pessoas = serv.processados.ocupacao(bordas)
+    esperas = serv.processados.atendido - chegadas
+    c_media, c_desvio_padrao, c_confianca = medias_em_lotes(pessoas[truncamento_mser(pessoas):])
+    e_media, e_desvio_padrao, e_confianca = medias_em_lotes(esperas[truncamento_mser(esperas):])
+
     print(f"Média de clientes {c_media:.2f} (±{c_confianca:.2f} @ 95%) (teorico: {rho/(1-rho):.2f}), desvio padrão {c_desvio_padrao:.2f}")
     print(f"Tempo médio de espera: {e_media:.2f} (±{e_confianca:.2f} @ 95%) (teorico: {rho / (mu - lamda):.2f}) desvio padrão {e_desvio_padrao:.2f}")
+    return (c_media, c_desvio_padrao, c_confianca), (e_media, e_desvio_padrao, e_confianca)
 
-def estima_terminacoes(lamda, mu, tempo_maximo=100):
-    terminations = 0
+def terminacoes_em_lote(lamda, mu, replicacoes, tempo_maximo=100, deterministic=False, rng=None):
+    # Avanca todas as replicacoes de run_until_empty juntas, um cliente por
+    # passo, mantendo apenas os indices das que ainda estao ocupadas.
+    if rng is None:
+        rng = np.random.default_rng()
+    saidas = rng.exponential(1/mu, replicacoes)
+    chegadas = np.zeros(replicacoes)
+    terminou = np.zeros(replicacoes, dtype=bool)
+    ativos = np.flatnonzero(saidas < tempo_maximo)
+    while len(ativos):
+        if deterministic:
+            chegadas[ativos] += 1/mu
+        else:
+            chegadas[ativos] += rng.exponential(1/lamda, len(ativos))
+        vazio = chegadas[ativos] >= saidas[ativos]
+        terminou[ativos[vazio]] = True
+        ativos = ativos[~vazio]
+        novas_saidas = saidas[ativos] + rng.exponential(1/mu, len(ativos))
+        dentro = novas_saidas < tempo_maximo
+        ativos = ativos[dentro]
+        saidas[ativos] = novas_saidas[dentro]
+    return terminou.mean(), np.where(terminou, saidas, np.nan)
+
+def estima_terminacoes(lamda, mu, tempo_maximo=100, workers=None, seed=None, em_lote=False,
+                       perfil=False, mostra=True):
     tries = 10000
-    for n in range(tries):
-        serv = Servidor(lamda=lamda, mu=mu, tempo_maximo=tempo_maximo)
-        terminated = serv.run_until_empty()
-        if terminated:
-            terminations += 1
-    print(f"O sistema (lambda={lamda}, mu={mu}) termina {100 * terminations / tries}% das vezes")
+    perfil = Perfil() if perfil else None
+    if em_lote:
+        fracao, _ = terminacoes_em_lote(lamda, mu, tries, tempo_maximo=tempo_maximo,
+                                        rng=np.random.default_rng(seed))
+        terminations = round(fracao * tries)
+    else:
+        terminations = sum(executa_replicacoes(replica_terminacao, tries, workers=workers, seed=seed,
+                                               perfil=perfil,
+                                               lamda=lamda, mu=mu, tempo_maximo=tempo_maximo))
+    resultado = dict(replicacoes=tries, fracao_terminacoes=terminations / tries)
+    if perfil is not None:
+        resultado.update(perfil.resumo())
+    if mostra:
+        print(f"O sistema (lambda={lamda}, mu={mu}) termina {100 * terminations / tries}% das vezes")
+        if perfil is not None:
+            print(perfil.relatorio())
+    return resultado
 
-def estima_terminacoes_com_max_clientes(lamda, mu, max_clientes, tempo_maximo=100):
-    terminations = 0
+def transbordamento_por_divisao(lamda, mu, max_clientes, particulas=10000, passo=100, grupos=10,
+                                rng=None):
+    # run_with_max_clientes_until_empty so depende da cadeia de saltos da
+    # M/M/1: cada transicao e uma chegada com prob. p = lamda/(lamda+mu) ou
+    # uma saida, e a fila transborda se max_clientes+1 chegadas entram antes
+    # de ela esvaziar. Para p < 1/2 os caminhos que dominam esse evento tem
+    # tantas saidas quanto chegadas, entao as particulas andam com a cadeia
+    # critica (p' = 1/2) com peso de razao de verossimilhanca, e a cada
+    # `passo` chegadas sao reamostradas segundo psi(x) = x (2q)^x, a
+    # autofuncao da recursao para tras em x clientes no sistema. O produto
+    # das medias dos pesos e um estimador nao viesado; o erro relativo vem
+    # da dispersao entre grupos independentes de particulas.
+    if rng is None:
+        rng = np.random.default_rng()
+    p = lamda / (lamda + mu)
+    q = 1 - p
+    if p < 0.5:
+        p_simulado = 0.5
+        log_psi = lambda x: np.log(x) + x * np.log(2 * q)
+    else:
+        p_simulado = p
+        log_psi = lambda x: np.zeros(len(x))
+    alvo = max_clientes + 1
+    por_grupo = max(1, particulas // grupos)
+    log_estimativas = np.empty(grupos)
+    for grupo in range(grupos):
+        no_sistema = np.ones(por_grupo, dtype=np.int64)
+        log_estimativa = float(log_psi(no_sistema[:1])[0])
+        nivel = 0
+        while nivel < alvo:
+            proximo = min(nivel + passo, alvo)
+            inicio = no_sistema.copy()
+            chegadas = np.full(por_grupo, nivel)
+            log_peso = np.zeros(por_grupo)
+            ativos = np.arange(por_grupo)
+            while len(ativos):
+                chegou = rng.random(len(ativos)) < p_simulado
+                chegadas[ativos] += chegou
+                no_sistema[ativos] += np.where(chegou, 1, -1)
+                log_peso[ativos] += np.where(chegou, np.log(p / p_simulado),
+                                             np.log(q / (1 - p_simulado)))
+                ativos = ativos[(no_sistema[ativos] > 0) & (chegadas[ativos] < proximo)]
+            vivos = no_sistema > 0
+            if not vivos.any():
+                log_estimativa = -np.inf
+                break
+            log_peso -= log_psi(inicio)
+            if proximo < alvo:
+                log_peso[vivos] += log_psi(no_sistema[vivos])
+            log_peso[~vivos] = -np.inf
+            maior = log_peso.max()
+            pesos = np.exp(log_peso - maior)
+            log_estimativa += maior + np.log(pesos.mean())
+            no_sistema = no_sistema[rng.choice(por_grupo, por_grupo, p=pesos / pesos.sum())]
+            nivel = proximo
+        log_estimativas[grupo] = log_estimativa
+    maior = log_estimativas.max()
+    if not np.isfinite(maior):
+        return 0.0, np.inf
+    estimativas = np.exp(log_estimativas - maior)
+    erro = estimativas.std(ddof=1) / np.sqrt(grupos) / estimativas.mean()
+    return float(np.exp(maior) * estimativas.mean()), float(erro)
+
+def estima_terminacoes_com_max_clientes(lamda, mu, max_clientes, tempo_maximo=100, workers=None, seed=None,
+                                        eventos_raros=False, perfil=False, mostra=True):
     tries = 10000
-    for n in range(tries):
-        serv = Servidor(lamda=lamda, mu=mu, tempo_maximo=tempo_maximo)
-        terminated = serv.run_with_max_clientes_until_empty(max_clientes)
-        if terminated:
-            terminations += 1
-    print(f"O sistema (lambda={lamda}, mu={mu}, fila_max={max_clientes}) termina {100 * terminations / tries}% das vezes")
-
-def simula_epidemias(lamda, mu, tempo_maximo=100, deterministic=False):
-    medias = []
-    quantas_parou = 0
-    n = 10000
-    for _ in range(n):
-        serv = Servidor(lamda=lamda, mu=mu, tempo_maximo=tempo_maximo)
-        parou = serv.run_until_empty(deterministic=deterministic)
-        # numero_medio_clientes, tempo_medio_espera, _ = serv.info_clientes()
-        ultima_saida = serv.gera_arvore()
-        info_arvore = serv.info_arvore()
-        #serv.print_arvore(serv.arvore[0])
-        medias.append((*info_arvore, ultima_saida))
-        if parou:
-            quantas_parou += 1
-    def media_desvio_padrao(l):
-        media = np.mean(l)
-        desvio = np.std(l)
-        confianca = 1.984 * (desvio / np.sqrt(len(l)))
-        return media, desvio, confianca 
+    perfil = Perfil() if perfil else None
+    resultado = dict(replicacoes=tries)
+    if eventos_raros:
+        probabilidade, erro = transbordamento_por_divisao(lamda, mu, max_clientes, particulas=tries,
+                                                          rng=np.random.default_rng(seed))
+        if mostra:
+            print(f"O sistema (lambda={lamda}, mu={mu}, fila_max={max_clientes}) transborda com probabilidade {probabilidade:.3e} (erro relativo {100 * erro:.1f}%)")
+        resultado.update(probabilidade_transbordamento=probabilidade, erro_relativo=erro)
+        terminations = tries * (1 - probabilidade)
+    else:
+        terminations = sum(executa_replicacoes(replica_terminacao_com_max_clientes, tries,
+                                               workers=workers, seed=seed, perfil=perfil,
+                                               lamda=lamda, mu=mu, max_clientes=max_clientes,
+                                               tempo_maximo=tempo_maximo))
+    resultado.update(fracao_terminacoes=terminations / tries)
+    if perfil is not None:
+        resultado.update(perfil.resumo())
+    if mostra:
+        print(f"O sistema (lambda={lamda}, mu={mu}, fila_max={max_clientes}) termina {100 * terminations / tries}% das vezes")
+        if perfil is not None:
+            print(perfil.relatorio())
+    return resultado
+
+def controles_epidemia(lamda, mu, deterministic, tempo_maximo, tolerancia=1e-6):
+    # Esperancas conhecidas por coluna de info_arvore + duracao: os filhos da
+    # raiz sao as chegadas durante um atendimento exponencial (Poisson(rho),
+    # ou 1/(e-1) com chegadas a cada 1/mu), e para rho < 1 o periodo ocupado
+    # tem 1/(1-rho) clientes e dura 1/(mu-lamda). Essas esperancas sao da
+    # arvore sem o corte em tempo_maximo, entao cada controle so entra quando
+    # um limitante de Chernoff diz que o corte quase nunca o atinge.
+    rho = lamda/mu
+    # a contagem dos filhos da raiz so muda se a saida do ultimo deles,
+    # S_0 + S_1 + ... + S_K, passar de tempo_maximo; com K | S_0 ~
+    # Poisson(lamda S_0) (ou <= mu S_0 chegadas deterministicas) a funcao
+    # geradora dessa soma e mu / (mu - theta - taxa * log-ou-razao de M)
+    theta = np.linspace(0, mu, 10001)[1:-1]
+    if deterministic:
+        denominador = mu - theta - mu * np.log(mu / (mu - theta))
+    else:
+        denominador = mu - theta - lamda * theta / (mu - theta)
+    validos = denominador > 0
+    log_cauda_raiz = np.min(np.log(mu) - np.log(denominador[validos])
+                            - theta[validos] * tempo_maximo)
+    esperancas = {}
+    if log_cauda_raiz < np.log(tolerancia):
+        esperancas[0] = 1/(np.e - 1) if deterministic else rho
+    # P(periodo ocupado > T) <= sqrt(mu/lamda) exp(-(sqrt(mu) - sqrt(lamda))^2 T)
+    if not deterministic and rho < 1:
+        log_cauda = 0.5 * np.log(mu / lamda) - (np.sqrt(mu) - np.sqrt(lamda))**2 * tempo_maximo
+        if log_cauda < np.log(tolerancia):
+            esperancas.update({4: 1/(1 - rho), 5: 1/(mu - lamda)})
+    return esperancas
+
+def simula_epidemias(lamda, mu, tempo_maximo=100, deterministic=False, workers=None, seed=None,
+                     ramificacao=False, precisao=None, controle=False, perfil=False, mostra=True):
+    # com chegadas deterministicas os filhos de cada no deixam de ser
+    # independentes, entao so o caminho por eventos vale
+    if ramificacao and not deterministic:
+        replica = replica_ramificacao
+        parametros = dict(lamda=lamda, mu=mu, tempo_maximo=tempo_maximo)
+    else:
+        replica = replica_epidemia
+        parametros = dict(lamda=lamda, mu=mu, tempo_maximo=tempo_maximo,
+                          deterministic=deterministic)
+    perfil = Perfil() if perfil else None
+    if precisao is not None:
+        resultados = replicacoes_sequenciais(replica, precisao_relativa=precisao, lote=1000,
+                                             workers=workers, seed=seed, perfil=perfil,
+                                             **parametros)
+    else:
+        resultados = executa_replicacoes(replica, 10000, workers=workers, seed=seed,
+                                         perfil=perfil, **parametros)
+    n = len(resultados)
+    medias = [resultado[:-1] for resultado in resultados]
+    quantas_parou = sum(resultado[-1] for resultado in resultados)
     lista_resultados = list(map(media_desvio_padrao, zip(*medias)))
+    if controle:
+        dados = np.array(medias, dtype=float)
+        esperancas = controles_epidemia(lamda, mu, deterministic, tempo_maximo)
+        for i in range(dados.shape[1]):
+            colunas = [j for j in esperancas if j != i]
+            if colunas:
+                lista_resultados[i] = estimador_controle(dados[:, i], dados[:, colunas],
+                                                         [esperancas[j] for j in colunas])
     # filhos_raiz, max_filhos, self.arvore[-1].geracao, media_alturas, len(self.arvore)
     descricoes = ["Grau de saída da raiz: ",
                   "Grau de saída máximo: ",
@@ -299,6 +1636,16 @@ def simula_epidemias(lamda, mu, tempo_maximo=100, deterministic=False):
                   "Número de infectados: ",
                   "Duração do periodo ocupado: "]
 
+    nomes = ['filhos_raiz', 'max_filhos', 'altura', 'media_alturas', 'infectados', 'duracao']
+    linha = dict(replicacoes=n, fracao_finitas=quantas_parou/n)
+    for nome, (media, desvio, confianca) in zip(nomes, lista_resultados):
+        linha.update({f'{nome}_media': media, f'{nome}_desvio': desvio,
+                      f'{nome}_confianca': confianca})
+    if perfil is not None:
+        linha.update(perfil.resumo())
+    if not mostra:
+        return linha
+
     print("------\nResultados (média, desvio, intervalo de confiança):\n------")
     for descricao, resultado in zip(descricoes, lista_resultados):
         prefix = "\item "
@@ -306,38 +1653,77 @@ def simula_epidemias(lamda, mu, tempo_maximo=100, deterministic=False):
         print(prefix, descricao, resultado_str)
 
     print("\item Fração de filas finitas: $" + str(round(quantas_parou/n, 3) * 100) + "\%$")
+    print(f"\item Replicações: ${n}$")
+    if perfil is not None:
+        print(perfil.relatorio())
+    return linha
+
+def carrega_experimento(caminho, comando):
+    # TOML ou JSON com uma lista de casos e, opcionalmente, parametros comuns
+    # em padrao; uma secao com o nome do comando, se existir, tem precedencia
+    with open(caminho, 'rb') as arquivo:
+        if caminho.endswith('.toml'):
+            import tomllib
+            dados = tomllib.load(arquivo)
+        else:
+            dados = json.load(arquivo)
+    secao = dados.get(comando, dados)
+    padrao = secao.get('padrao', {})
+    return [{**padrao, **caso} for caso in secao['casos']]
+
+def terminacoes_caso(**caso):
+    if 'max_clientes' in caso:
+        return estima_terminacoes_com_max_clientes(**caso)
+    return estima_terminacoes(**caso)
+
+def cdfs_caso(lamda, mu, tempo_maximo=100, rastro=None, pontos=2000, exporta=None, mostra=False):
+    pessoas, espera = gera_cdfs(lamda, mu, tempo_maximo=tempo_maximo,
+                                rastro=Rastro(rastro) if rastro is not None else None,
+                                pontos=pontos, exporta=exporta)
+    return dict(arquivo=exporta or f"m_m_1_queue_lambda_{lamda}_mu_{mu}.png",
+                pontos_pessoas=len(pessoas[0]), pontos_espera=len(espera[0]))
+
+COMANDOS = {
+    'simulate': simula_servidores,
+    'terminations': terminacoes_caso,
+    'epidemics': simula_epidemias,
+    'cdfs': cdfs_caso,
+}
+
+def escreve_resultados(linhas, formato, arquivo):
+    if formato == 'csv':
+        colunas = list(dict.fromkeys(coluna for linha in linhas for coluna in linha))
+        escritor = csv.DictWriter(arquivo, fieldnames=colunas)
+        escritor.writeheader()
+        escritor.writerows(linhas)
+    else:
+        json.dump(linhas, arquivo, indent=2, default=lambda valor: valor.item())
+        arquivo.write('\n')
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Simulações de filas M/M/1 e epidemias")
+    comandos = parser.add_subparsers(dest='comando', required=True)
+    for nome in COMANDOS:
+        comando = comandos.add_parser(nome)
+        comando.add_argument('experimento', help="arquivo .toml ou .json com os casos")
+        comando.add_argument('--formato', choices=('json', 'csv'), default='json')
+        comando.add_argument('--saida', help="arquivo de saída (padrão: stdout)")
+        comando.add_argument('--workers', type=int)
+    args = parser.parse_args(argv)
+
+    linhas = []
+    for caso in carrega_experimento(args.experimento, args.comando):
+        if args.workers is not None and args.comando != 'cdfs':
+            caso.setdefault('workers', args.workers)
+        resultado = COMANDOS[args.comando](mostra=False, **caso)
+        linhas.append({**caso, **resultado})
+    if args.saida is None:
+        escreve_resultados(linhas, args.formato, sys.stdout)
+    else:
+        with open(args.saida, 'w', newline='') as arquivo:
+            escreve_resultados(linhas, args.formato, arquivo)
+    return linhas
 
-    
-    
-    
 if __name__ == "__main__":
-    print("\nCaso 1:")
-    simula_epidemias(lamda=1, mu=2, tempo_maximo=1000)
-    print("\nCaso 1 (determinístico):")
-    simula_epidemias(lamda=1, mu=2, tempo_maximo=1000, deterministic=True)
-    print("\nCaso 2:")
-    simula_epidemias(lamda=2, mu=4, tempo_maximo=1000)
-    print("\nCaso 2 (determinístico):")
-    simula_epidemias(lamda=2, mu=4, tempo_maximo=1000, deterministic=True)
-    print("\nCaso 3:")
-    simula_epidemias(lamda=1.05, mu=1, tempo_maximo=1000)
-    print("\nCaso 3 (determinístico):")
-    simula_epidemias(lamda=1.05, mu=1, tempo_maximo=1000, deterministic=True)
-    print("\nCaso 4:")
-    simula_epidemias(lamda=1.1, mu=1, tempo_maximo=1000)
-    print("\nCaso 4 (determinístico):")
-    simula_epidemias(lamda=1.1, mu=1, tempo_maximo=1000, deterministic=True)
-
-
-    '''
-    gera_cdfs(lamda=1, mu=2)
-    gera_cdfs(lamda=2, mu=4)
-    estima_terminacoes(lamda=2,    mu=4)
-    estima_terminacoes(lamda=1,    mu=2)
-    estima_terminacoes(lamda=1.05, mu=1, tempo_maximo=10000)
-    estima_terminacoes(lamda=1.10, mu=1, tempo_maximo=10000)
-    estima_terminacoes_com_max_clientes(lamda=1.05, mu=1, max_clientes=1000)
-    estima_terminacoes_com_max_clientes(lamda=1.1, mu=1, max_clientes=1000)
-    estima_terminacoes_com_max_clientes(lamda=1, mu=2, max_clientes=1000)
-    estima_terminacoes_com_max_clientes(lamda=2, mu=4, max_clientes=1000)
-    '''
+    main()